@@ -0,0 +1,199 @@
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    from .locks import file_lock
+except Exception:
+    from locks import file_lock
+
+# Route: (max concurrent requests, max requests per second), 0 is no limit.
+# They're only used if the server is started with "--default-limits"
+DEFAULT_LIMITS = {
+    'project/build': (16, 0),
+    'project/diagnose': (2, 0),
+    'license/new': (4, 10),
+    'license/bulk': (1, 1),
+    'register': (1, 1),
+}
+
+_limits = {}
+
+
+class Rejected(RuntimeError):
+    """The request is rejected, retry it after some seconds."""
+
+    def __init__(self, route, reason, retry_after):
+        super(Rejected, self).__init__(
+            'Too many requests of %s, retry after %d seconds'
+            % (route, retry_after))
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limit(object):
+    """Limit concurrent requests and rate of one route.
+
+    The rate is limited by token bucket, the bucket size is `rate` (at
+    least 1), so that at most `rate` requests are admitted in one
+    burst. The average duration of requests is used to estimate when
+    to retry.
+
+    If slots (see locks.Slots) is set, the limits are shared by all the
+    server processes, each admitted request takes one slot, and the
+    bucket is saved in a file of slots path.
+
+    >>> limit = Limit('register', 1, 1)
+    >>> limit.acquire()
+    >>> try:
+    ...     limit.acquire()
+    ... except Rejected as e:
+    ...     print(e.reason, e.retry_after)
+    concurrency 1
+    >>> limit.release(0.1)
+    >>> try:
+    ...     limit.acquire()
+    ... except Rejected as e:
+    ...     print(e)
+    Too many requests of register, retry after 1 seconds
+    """
+
+    def __init__(self, route, concurrency=0, rate=0, slots=None):
+        self.route = route
+        self.name = 'route-' + route.replace('/', '-')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.slots = slots
+        self.active = 0
+        self.admitted = 0
+        self.rejected = {'concurrency': 0, 'rate': 0}
+        self.duration = 0.0
+        self._tokens = max(rate, 1.0)
+        self._checked = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(max(self.rate, 1.0), self._tokens
+                           + (now - self._checked) * self.rate)
+        self._checked = now
+
+    def _take_token(self):
+        """Take one token, return the tokens before taking."""
+        if self.slots is None:
+            self._refill(time.time())
+            tokens = self._tokens
+            if tokens >= 1:
+                self._tokens -= 1
+            return tokens
+
+        filename = os.path.join(self.slots.path, self.name + '.json')
+        with file_lock(filename):
+            try:
+                with open(filename) as f:
+                    self._tokens, self._checked = json.load(f)
+            except (OSError, ValueError):
+                pass
+            self._refill(time.time())
+            tokens = self._tokens
+            if tokens >= 1:
+                self._tokens -= 1
+            with open(filename, 'w') as f:
+                json.dump([self._tokens, self._checked], f)
+        return tokens
+
+    def acquire(self):
+        """Admit one request, or raise Rejected.
+
+        Return the slot taken by this request, it's passed to release.
+        """
+        with self._lock:
+            slot = None
+            if self.concurrency:
+                if self.active < self.concurrency and self.slots:
+                    slot = self.slots.acquire(self.name, self.concurrency)
+                    full = slot is None
+                else:
+                    full = self.active >= self.concurrency
+                if full:
+                    self.rejected['concurrency'] += 1
+                    # Requests are not queued, so the retry hint is only
+                    # the average time one of the active ones finishes
+                    wait = self.duration / self.concurrency
+                    raise Rejected(self.route, 'concurrency',
+                                   max(1, int(math.ceil(wait))))
+            if self.rate:
+                tokens = self._take_token()
+                if tokens < 1:
+                    if self.slots:
+                        self.slots.release(slot)
+                    self.rejected['rate'] += 1
+                    wait = (1 - tokens) / self.rate
+                    raise Rejected(self.route, 'rate',
+                                   max(1, int(math.ceil(wait))))
+            self.active += 1
+            self.admitted += 1
+            return slot
+
+    def release(self, duration, slot=None):
+        with self._lock:
+            if slot is not None:
+                self.slots.release(slot)
+            self.active -= 1
+            self.duration = duration if not self.duration \
+                else self.duration * 0.8 + duration * 0.2
+
+
+def parse_limit(value):
+    """Parse "ROUTE=CONCURRENCY[/RATE]".
+
+    >>> parse_limit('project/build=4/0.5')
+    ('project/build', 4, 0.5)
+    """
+    try:
+        route, n = value.split('=')
+        n, rate = (n + '/0').split('/')[:2]
+        return route.strip('/'), int(n), float(rate)
+    except ValueError:
+        raise ValueError('Invalid limit "%s"' % value)
+
+
+def configure(limits=(), slots=None, defaults=False):
+    """Set the limits of routes, the items are (route, concurrency, rate).
+    If defaults is True, they override DEFAULT_LIMITS, otherwise only
+    these routes are limited. The limits are shared by the server
+    processes if slots is set."""
+    values = dict(DEFAULT_LIMITS) if defaults else {}
+    for route, n, rate in limits:
+        values[route] = n, rate
+    _limits.clear()
+    for route, (n, rate) in values.items():
+        if n or rate:
+            _limits[route] = Limit(route, n, rate, slots)
+
+
+def get_limit(route):
+    return _limits.get(route)
+
+
+def metrics():
+    """Return lines of metrics in Prometheus text format."""
+    limits = sorted(_limits.items())
+    lines = ['# TYPE pyarmor_webui_admitted_total counter']
+    lines.extend('pyarmor_webui_admitted_total{route="%s"} %d'
+                 % (route, x.admitted) for route, x in limits)
+    lines.append('# TYPE pyarmor_webui_rejected_total counter')
+    for route, x in limits:
+        lines.extend('pyarmor_webui_rejected_total{route="%s",reason="%s"} '
+                     '%d' % (route, k, n)
+                     for k, n in sorted(x.rejected.items()))
+    lines.append('# TYPE pyarmor_webui_active gauge')
+    lines.extend('pyarmor_webui_active{route="%s"} %d' % (route, x.active)
+                 for route, x in limits)
+    return lines
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,265 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from tempfile import TemporaryFile
+from urllib.parse import parse_qsl
+
+from . import scheduler, trash, workers
+from .handler import BaseHandler
+from .history import pyarmor_version
+from .remote import BUNDLE_PATH, TOKEN_ENV, TOKEN_HEADER, extract_tree, \
+    snapshot, tree_digest
+from .server import HelperHandler, HelperServer, __config__, \
+    load_root_handler
+
+# Each request waits for a build at most N seconds
+MAX_WAIT = 10
+
+
+class AgentHandler(BaseHandler):
+    """Build projects for the coordinator in this machine.
+
+    The source bundles are cached in "agents/bundles" of data path, and
+    each build has its own path in "agents/jobs" until it's cleaned.
+
+    The build runs in background, the server polls it by "wait" and
+    cancels it by "cancel".
+    """
+
+    unlocked_routes = 'status', 'has', 'build', 'wait', 'cancel', 'clean'
+
+    def __init__(self, config, project):
+        super(AgentHandler, self).__init__(config)
+        self.name = 'agent'
+        self.project = project
+        self.jobs = {}
+        self._cond = threading.Condition()
+
+    def _bundle_path(self, digest):
+        if not re.match('^[0-9a-f]{64}$', digest or ''):
+            raise RuntimeError('Invalid bundle digest "%s"' % digest)
+        return os.path.join(self._get_path(), BUNDLE_PATH, digest)
+
+    def _job_path(self, job):
+        if not re.match('^[0-9a-f]{32}$', job or ''):
+            raise RuntimeError('Invalid job "%s"' % job)
+        return os.path.join(self._get_path(), 'jobs', job)
+
+    def output_path(self, job):
+        return os.path.join(self._job_path(job), 'output')
+
+    def add_bundle(self, digest, fileobj):
+        path = self._bundle_path(digest)
+        if os.path.exists(path):
+            return path
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        os.makedirs(tmp)
+        try:
+            extract_tree(fileobj, tmp)
+            if tree_digest(snapshot(tmp)) != digest:
+                raise RuntimeError('Bundle %s is broken' % digest)
+            os.rename(tmp, path)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(path):
+                raise
+        logging.info('Add bundle %s', digest)
+        return path
+
+    def do_status(self, args=None):
+        jobs = scheduler.get_scheduler().jobs()
+        return {
+            'slots': scheduler.get_scheduler().max_jobs,
+            'running': len([x for x in jobs if x['state'] == 'running']),
+            'queued': len([x for x in jobs if x['state'] == 'queued']),
+            'pyarmor': pyarmor_version(),
+        }
+
+    def do_has(self, args):
+        return os.path.exists(self._bundle_path(args.get('digest')))
+
+    def do_build(self, args):
+        src = self._bundle_path(args.get('digest'))
+        if not os.path.exists(src):
+            raise RuntimeError('No bundle %s found' % args.get('digest'))
+
+        job = uuid.uuid4().hex
+        path = self._job_path(job)
+        os.makedirs(os.path.join(path, 'project'))
+        project = dict(args['project'], src=src, output=self.output_path(job),
+                       cleanOutput=False)
+        with self._cond:
+            self.jobs[job] = dict(state='running', error=None)
+        thread = threading.Thread(target=self._run, args=(job, project))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def _run(self, job, project):
+        path = self._job_path(job)
+
+        def build():
+            self.project._build_target(os.path.join(path, 'project'),
+                                       project)
+
+        state, error = 'finished', None
+        try:
+            scheduler.get_scheduler().run(
+                job, build, priority=project.get('priority', 0),
+                name=project.get('title'))
+        except scheduler.JobCancelled as e:
+            state, error = 'cancelled', str(e)
+        except Exception as e:
+            logging.exception('Build %s failed', job)
+            state, error = 'failed', str(e)
+        if state != 'finished':
+            trash.remove(path)
+        with self._cond:
+            self.jobs[job] = dict(state=state, error=error)
+            self._cond.notify_all()
+
+    def do_wait(self, args):
+        """Wait for the build at most "timeout" seconds, return its state,
+        None if it's unknown."""
+        job = args.get('job')
+        self._job_path(job)
+        timeout = min(float(args.get('timeout') or 0), MAX_WAIT)
+        with self._cond:
+            self._cond.wait_for(lambda: self.jobs.get(job, {}).get(
+                'state') != 'running', timeout)
+            result = self.jobs.get(job)
+            if result and result['state'] in ('failed', 'cancelled'):
+                del self.jobs[job]
+            return result
+
+    def do_cancel(self, args):
+        job = args.get('job')
+        self._job_path(job)
+        return bool(scheduler.get_scheduler().cancel(key=job))
+
+    def do_clean(self, args):
+        path = self._job_path(args.get('job'))
+        with self._cond:
+            self.jobs.pop(args.get('job'), None)
+        trash.remove(path)
+
+
+class AgentRequestHandler(HelperHandler):
+
+    server_version = 'PyarmorAgent/' + __config__['version']
+    token = None
+
+    def parse_request(self):
+        """Reject the request without the shared token."""
+        if not HelperHandler.parse_request(self):
+            return False
+        token = self.headers.get(TOKEN_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            self.send_error(401, "Invalid agent token")
+            return False
+        return True
+
+    def _query(self):
+        return dict(parse_qsl(self.path.split('?', 1)[-1]))
+
+    def _agent(self):
+        return self.root_handler.children[0]
+
+    def do_PUT(self):
+        """Receive source bundle."""
+        if not self.path.startswith('/agent/bundle?'):
+            self.send_error(404)
+            return
+
+        n = int(self.headers.get('Content-Length', 0))
+        result = dict(err=0)
+        try:
+            with TemporaryFile() as f:
+                while n > 0:
+                    data = self.rfile.read(min(n, 1024 * 1024))
+                    if not data:
+                        raise RuntimeError('Bundle is truncated')
+                    f.write(data)
+                    n -= len(data)
+                f.seek(0)
+                self._agent().add_bundle(self._query().get('digest'), f)
+        except Exception as e:
+            logging.exception("Failed to receive bundle")
+            result = dict(err=1, data=str(e))
+
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """Send build output as tar.gz archive."""
+        if not self.path.startswith('/agent/output?'):
+            self.send_error(404)
+            return
+        try:
+            path = self._agent().output_path(self._query().get('job'))
+        except RuntimeError as e:
+            self.send_error(400, str(e))
+            return
+        if not os.path.exists(path):
+            self.send_error(404, "No build output found")
+            return
+        self.send_archive(path, 'tar.gz')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='pyarmor-webui agent',
+        description='Build projects for pyarmor-webui server started '
+        'with option "--agent URL"',
+    )
+    parser.add_argument('-p', '--port', type=int, default=9097,
+                        help='Serve port, default is 9097')
+    parser.add_argument('-H', '--host', default='localhost',
+                        help='Bind host, default is localhost')
+    parser.add_argument('-j', '--slots', type=int, default=os.cpu_count(),
+                        help='Max builds run at the same time, default is '
+                        'the number of cpus')
+    parser.add_argument('--data-path',
+                        help='Where to save bundles, default is ~/.pyarmor')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='Run pyarmor in N warm worker processes')
+    parser.add_argument('--token', default=os.getenv(TOKEN_ENV),
+                        help='The token shared with server, default is '
+                        'environment variable %s' % TOKEN_ENV)
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('the shared token is required, set option --token or '
+                     'environment variable %s' % TOKEN_ENV)
+
+    if args.data_path:
+        __config__['homepath'] = os.path.abspath(args.data_path)
+    logging.info("Data path: %s", __config__['homepath'])
+    trash.configure(os.path.join(__config__['homepath'], trash.TRASH_PATH))
+
+    slots = max(args.slots or 1, 1)
+    scheduler.configure(slots, slots)
+    if args.pool_size:
+        workers.configure(args.pool_size, prestart='pyarmor.cli.__main__')
+
+    root = load_root_handler()
+    project = [x for x in root.children if x.name == 'project'][0]
+    AgentRequestHandler.token = args.token
+    AgentRequestHandler.root_handler = BaseHandler(__config__)
+    AgentRequestHandler.root_handler.children.append(
+        AgentHandler(__config__, project))
+
+    server = HelperServer((args.host, args.port), AgentRequestHandler)
+    logging.info("Agent serving HTTP on %s port %s with %d slots ...",
+                 server.server_address[0], server.server_address[1], slots)
+    server.serve_forever()
@@ -0,0 +1,221 @@
+import os
+import re
+import shutil
+import tarfile
+import zipfile
+import zlib
+
+from gzip import GzipFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 64 * 1024
+
+# Content encodings of response in order of preference
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# Members with these suffixes are already compressed, deflate them again
+# only costs cpu time
+STORED_SUFFIXES = (
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.7z', '.br',
+    '.whl', '.egg', '.jar', '.pyz', '.apk', '.dmg', '.pkg', '.msi',
+    '.png', '.jpg', '.jpeg', '.gif', '.ico', '.woff', '.woff2',
+)
+
+ARCHIVE_FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'tar.gz': ('.tar.gz', 'application/gzip'),
+}
+
+
+class ChunkedWriter(object):
+    """Write data to file object by HTTP chunked transfer encoding."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        if data:
+            self._fileobj.write(b'%X\r\n' % len(data))
+            self._fileobj.write(data)
+            self._fileobj.write(b'\r\n')
+        return len(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def close(self):
+        self._fileobj.write(b'0\r\n\r\n')
+        self._fileobj.flush()
+
+
+class CompressWriter(object):
+    """Compress data by gzip or brotli and write it to file object."""
+
+    def __init__(self, fileobj, encoding='gzip'):
+        self._fileobj = fileobj
+        if encoding == 'br':
+            c = brotli.Compressor(quality=5)
+            self._compress, self._finish = c.process, c.finish
+        elif encoding == 'gzip':
+            c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress, self._finish = c.compress, c.flush
+        else:
+            raise RuntimeError('Unsupported encoding "%s"' % encoding)
+
+    def write(self, data):
+        self._fileobj.write(self._compress(data))
+        return len(data)
+
+    def close(self):
+        self._fileobj.write(self._finish())
+
+
+def accept_encoding(value, encodings=ENCODINGS):
+    """Return the first of encodings accepted by header, None if no.
+
+    >>> accept_encoding('gzip, deflate', ('br', 'gzip'))
+    'gzip'
+    >>> accept_encoding('br;q=0, *', ('br', 'gzip'))
+    'gzip'
+    >>> accept_encoding('identity', ('br', 'gzip')) is None
+    True
+    """
+    accepted = {}
+    for item in (value or '').split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for x in parts[1:]:
+            x = x.strip()
+            if x.startswith('q='):
+                try:
+                    q = float(x[2:])
+                except ValueError:
+                    q = 0
+        accepted[parts[0].strip().lower()] = q
+    for x in encodings:
+        if accepted.get(x, accepted.get('*', 0)) > 0:
+            return x
+
+
+def is_compressed(path, size):
+    """Return True if it's no use to compress this file again.
+
+    Besides the well-known suffixes, the first chunk of big file is
+    sampled, it's enough to find PyInstaller bundles and other packed
+    binaries.
+    """
+    if path.lower().endswith(STORED_SUFFIXES):
+        return True
+    if size < CHUNK_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        data = f.read(CHUNK_SIZE)
+    return len(zlib.compress(data, 1)) > len(data) * 0.9
+
+
+def iter_entries(path):
+    """Yield (filename, arcname) for path and all the items in it.
+
+    The arcname of directory ends with "/", all the items are sorted so
+    that the same tree always gets same archive.
+    """
+    base = os.path.basename(os.path.normpath(path))
+    if not os.path.isdir(path):
+        yield path, base
+        return
+
+    yield path, base + '/'
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        prefix = os.path.relpath(root, path).replace('\\', '/')
+        prefix = base + '/' + ('' if prefix == '.' else prefix + '/')
+        for x in dirs:
+            yield os.path.join(root, x), prefix + x + '/'
+        for x in sorted(files):
+            yield os.path.join(root, x), prefix + x
+
+
+def write_zip(path, fileobj):
+    """Write path as zip archive to a non-seekable file object."""
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for filename, arcname in iter_entries(path):
+            zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b'')
+                continue
+            zinfo.compress_type = zipfile.ZIP_STORED \
+                if is_compressed(filename, zinfo.file_size) \
+                else zipfile.ZIP_DEFLATED
+            large = zinfo.file_size > zipfile.ZIP64_LIMIT
+            with open(filename, 'rb') as src, \
+                    zf.open(zinfo, 'w', force_zip64=large) as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def write_targz(path, fileobj, compresslevel=6):
+    """Write path as tar.gz archive to a non-seekable file object."""
+    with GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel,
+                  mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w|', bufsize=CHUNK_SIZE) as tar:
+            for filename, arcname in iter_entries(path):
+                tar.add(filename, arcname.rstrip('/'), recursive=False)
+
+
+def write_archive(path, fileobj, fmt='zip'):
+    if fmt == 'zip':
+        write_zip(path, fileobj)
+    elif fmt == 'tar.gz':
+        write_targz(path, fileobj)
+    else:
+        raise RuntimeError('Unsupported archive format "%s"' % fmt)
+
+
+def parse_range(value, size):
+    """Parse the value of header "Range" for a file with size bytes.
+
+    Only single range is supported, return (start, end) both are
+    inclusive, or None if the whole file should be sent. Raise
+    ValueError if the range is not satisfiable.
+
+    >>> parse_range('bytes=0-99', 1000)
+    (0, 99)
+    >>> parse_range('bytes=900-', 1000)
+    (900, 999)
+    >>> parse_range('bytes=-100', 1000)
+    (900, 999)
+    >>> parse_range('bytes=0-9,20-29', 1000) is None
+    True
+    """
+    m = re.match(r'^bytes=(\d*)-(\d*)$', value.strip()) if value else None
+    if m is None or m.groups() == ('', ''):
+        return None
+
+    start, end = m.groups()
+    if start == '':
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range "%s"' % value)
+    return start, end
+
+
+def copy_range(source, outputfile, start, length):
+    """Copy length bytes from offset start of file object source."""
+    source.seek(start)
+    while length > 0:
+        data = source.read(min(CHUNK_SIZE, length))
+        if not data:
+            break
+        outputfile.write(data)
+        length -= len(data)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import scheduler, trash, workers
+from .scheduler import PRIORITY_BATCH, JobCancelled
+from .server import __config__, load_root_handler
+
+
+def select_projects(projects, names):
+    """Return the projects by id, name or title, all if names is empty."""
+    if not names:
+        return list(projects)
+    result = []
+    for x in names:
+        for p in projects:
+            if x in (str(p['id']), p.get('name'), p.get('title')):
+                result.append(p)
+                break
+        else:
+            raise RuntimeError('No project "%s" found' % x)
+    return result
+
+
+def build_projects(root, projects, jobs=1, keep_going=False):
+    """Build projects in N threads, return the results in same order.
+
+    If keep_going is not set, the first failed build cancels all the
+    running builds and the others are skipped.
+    """
+    stop = threading.Event()
+
+    def build(p):
+        result = {
+            'id': p['id'],
+            'title': p.get('title'),
+            'state': 'skipped',
+            'output': None,
+            'error': None,
+            'duration': 0,
+        }
+        if stop.is_set():
+            return result
+
+        t = time.time()
+        try:
+            args = dict(p, priority=PRIORITY_BATCH)
+            result['output'] = root.dispatch('project/build', args)
+            result['state'] = 'finished'
+        except JobCancelled as e:
+            result.update(state='cancelled', error=str(e))
+        except Exception as e:
+            logging.error('Build project %s failed: %s', p['id'], e)
+            result.update(state='failed', error=str(e))
+            if not keep_going and not stop.is_set():
+                stop.set()
+                for x in projects:
+                    scheduler.get_scheduler().cancel(key=x['id'])
+        result['duration'] = round(time.time() - t, 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(build, projects))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='pyarmor-webui build',
+        description='Build saved projects without starting the server, '
+        'print summary as json',
+    )
+    parser.add_argument('projects', nargs='*', metavar='PROJECT',
+                        help='Project id, name or title, default is all')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Build N projects at the same time')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--fail-fast', dest='keep_going',
+                       action='store_false',
+                       help='Stop all the builds if one fails (default)')
+    group.add_argument('-k', '--keep-going', action='store_true',
+                       help='Build all the projects even if some fail')
+    parser.set_defaults(keep_going=False)
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write summary to FILE, default is stdout')
+    parser.add_argument('-7', '--enable-v7', action='store_true',
+                        help='Force to use Pyarmor 7 commands')
+    parser.add_argument('--data-path',
+                        help='Where projects are saved, default is ~/.pyarmor')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='Run pyarmor in N warm worker processes')
+    parser.add_argument('--build-timeout', type=int, default=0,
+                        help='Cancel build if it runs more than N seconds')
+    args = parser.parse_args(argv)
+
+    if args.data_path:
+        __config__['homepath'] = os.path.abspath(args.data_path)
+    trash.configure(os.path.join(__config__['homepath'], trash.TRASH_PATH))
+
+    root = load_root_handler(args.enable_v7)
+    try:
+        projects = select_projects(root.dispatch('project/list', {}),
+                                   args.projects)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    jobs = max(args.jobs, 1)
+    scheduler.configure(jobs, 1, args.build_timeout)
+    if args.pool_size:
+        workers.configure(args.pool_size, prestart='pyarmor.pyarmor'
+                          if args.enable_v7 else 'pyarmor.cli.__main__')
+
+    t0 = time.time()
+    try:
+        results = build_projects(root, projects, jobs, args.keep_going)
+    finally:
+        workers.configure(0)
+
+    # The time of each phase is in build history
+    history = root.dispatch('project/history', {'since': t0 - 1,
+                                                'limit': len(results)})
+    phases = {}
+    for rec in history['records'][::-1]:
+        phases[rec['project']] = rec['phases']
+    for x in results:
+        if x['state'] != 'skipped':
+            x['phases'] = phases.get(x['id'], {})
+
+    summary = {'total': len(results), 'duration': round(time.time() - t0, 3)}
+    for state in ('finished', 'failed', 'cancelled', 'skipped'):
+        summary[state] = len([x for x in results if x['state'] == state])
+    summary['projects'] = results
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+    trash.wait()
+
+    return 0 if summary['finished'] == len(results) else 1
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import posixpath
+import struct
+
+# The bundle file in homepath
+BUNDLE_FILE = 'static.bundle'
+
+MAGIC = b'PAWBNDL1'
+
+# The trailer is the offset and size of index
+TRAILER = struct.Struct('>QQ')
+
+
+def wwwroot_signature(wwwroot):
+    """Return the signature of all the files in wwwroot, it's changed
+    when any file is added, removed or modified."""
+    items = []
+    for root, dirs, files in os.walk(wwwroot):
+        dirs.sort()
+        for name in sorted(files):
+            fs = os.stat(os.path.join(root, name))
+            path = os.path.relpath(os.path.join(root, name), wwwroot)
+            items.append([path.replace(os.sep, '/'), fs.st_size,
+                          fs.st_mtime_ns])
+    return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+
+def guess_type(path, extensions_map):
+    """Guess MIME type by extension like HelperHandler.guess_type.
+
+    >>> guess_type('a.CSS', {'': 'bin', '.css': 'text/css'})
+    'text/css'
+    """
+    ext = posixpath.splitext(path)[1]
+    if ext in extensions_map:
+        return extensions_map[ext]
+    return extensions_map.get(ext.lower(), extensions_map[''])
+
+
+def build_bundle(wwwroot, filename, extensions_map):
+    """Pack all the files in wwwroot to one bundle file.
+
+    The bundle is magic, data of files, index as JSON, and trailer.
+    The index maps each path to [offset, size, etag, ctype, mtime], the
+    list "dirs" has all the sub directories.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(path, 'www', 'css'))
+    >>> with open(os.path.join(path, 'www', 'css', 'a.css'), 'w') as f:
+    ...     n = f.write('body {}')
+    >>> filename = os.path.join(path, BUNDLE_FILE)
+    >>> build_bundle(os.path.join(path, 'www'), filename, {'': 'text'})
+    >>> b = Bundle(filename)
+    >>> b.lookup('css/a.css')['size'], b.is_dir('css'), b.is_dir('')
+    (7, True, True)
+    >>> b.read(b.lookup('css/a.css'))
+    b'body {}'
+    >>> b.close()
+    """
+    signature = wwwroot_signature(wwwroot)
+    files, dirs = {}, []
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpname, 'wb') as output:
+        output.write(MAGIC)
+        for root, subdirs, names in os.walk(wwwroot):
+            subdirs.sort()
+            prefix = os.path.relpath(root, wwwroot).replace(os.sep, '/')
+            prefix = '' if prefix == '.' else prefix + '/'
+            dirs.extend(prefix + x for x in subdirs)
+            for name in sorted(names):
+                src = os.path.join(root, name)
+                with open(src, 'rb') as f:
+                    data = f.read()
+                files[prefix + name] = [
+                    output.tell(), len(data),
+                    '"%s"' % hashlib.sha1(data).hexdigest()[:16],
+                    guess_type(name, extensions_map),
+                    int(os.stat(src).st_mtime)]
+                output.write(data)
+        offset = output.tell()
+        index = json.dumps(dict(signature=signature, files=files,
+                                dirs=dirs)).encode()
+        output.write(index)
+        output.write(TRAILER.pack(offset, len(index)))
+    os.replace(tmpname, filename)
+
+
+def read_signature(filename):
+    """Return the signature of wwwroot saved in the bundle, None if the
+    bundle is missing or broken."""
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            offset, size = TRAILER.unpack(f.read(TRAILER.size))
+            f.seek(offset)
+            return json.loads(f.read(size).decode())['signature']
+    except Exception:
+        return None
+
+
+def open_bundle(wwwroot, filename, extensions_map):
+    """Return the bundle of wwwroot, rebuild it if it's missing or
+    stale. The bundle is used as it is if wwwroot doesn't exist."""
+    if os.path.isdir(wwwroot):
+        if read_signature(filename) != wwwroot_signature(wwwroot):
+            logging.info('Build static bundle %s', filename)
+            path = os.path.dirname(filename)
+            if not os.path.exists(path):
+                os.makedirs(path, exist_ok=True)
+            build_bundle(wwwroot, filename, extensions_map)
+    elif not os.path.exists(filename):
+        raise RuntimeError('No static bundle or path %s' % wwwroot)
+    return Bundle(filename)
+
+
+class Bundle(object):
+    """The bundle file is mapped to memory, the files in it are looked
+    up in the index."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise RuntimeError('Invalid static bundle %s' % filename)
+        offset, size = TRAILER.unpack(self._mmap[-TRAILER.size:])
+        index = json.loads(self._mmap[offset:offset+size].decode())
+        self.files = {}
+        for path, (offset, size, etag, ctype, mtime) in \
+                index['files'].items():
+            self.files[path] = dict(offset=offset, size=size, etag=etag,
+                                    ctype=ctype, mtime=mtime)
+        self.dirs = set(index['dirs'])
+        self.dirs.add('')
+
+    @staticmethod
+    def normpath(path):
+        """Return the key of url path in the index."""
+        path = posixpath.normpath('/' + path).lstrip('/')
+        return '' if path == '.' else path
+
+    def is_dir(self, path):
+        return path in self.dirs
+
+    def lookup(self, path):
+        return self.files.get(path)
+
+    def read(self, entry):
+        offset = entry['offset']
+        return self._mmap[offset:offset+entry['size']]
+
+    def close(self):
+        self._mmap.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,134 @@
+import itertools
+import logging
+import threading
+import time
+
+from collections import deque
+
+# Max events kept for each subscriber, the oldest one is dropped if
+# the client is too slow to read them
+QUEUE_SIZE = 100
+
+# The last N events are replayed to the client reconnected with the id
+# of last received event
+HISTORY_SIZE = 100
+
+
+class Subscriber(object):
+    """The bounded queue of events for one client."""
+
+    def __init__(self, prefixes=None, maxsize=QUEUE_SIZE):
+        self.prefixes = tuple(prefixes or ())
+        self.dropped = 0
+        self._events = deque(maxlen=maxsize)
+        self._cond = threading.Condition()
+
+    def accept(self, event):
+        return not self.prefixes or event['type'].startswith(self.prefixes)
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Return a list of events, it's empty if timeout.
+
+        If some events are dropped, an event "dropped" with the count is
+        inserted, the client should reload the data.
+        """
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            if self.dropped:
+                events.insert(0, dict(id=None, type='dropped',
+                                      time=time.time(),
+                                      data={'count': self.dropped}))
+                self.dropped = 0
+        return events
+
+
+class EventBus(object):
+    """Publish events to all the subscribers.
+
+    Publishing never blocks, each subscriber has its own bounded queue.
+
+    >>> bus = EventBus()
+    >>> s = bus.subscribe(['build.'])
+    >>> bus.publish('project.changed', id=1)
+    >>> bus.publish('build.started', id=2)
+    >>> [(x['id'], x['type'], x['data']) for x in s.get(0)]
+    [(2, 'build.started', {'id': 2})]
+    >>> [x['type'] for x in bus.subscribe(last_id=1).get(0)]
+    ['build.started']
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._history = deque(maxlen=HISTORY_SIZE)
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self.relay = None
+
+    def subscribe(self, prefixes=None, last_id=None):
+        """Return a subscriber of event types with these prefixes.
+
+        The events after last_id in history are put in its queue.
+        """
+        s = Subscriber(prefixes)
+        with self._lock:
+            if last_id is not None:
+                for event in self._history:
+                    if event['id'] > last_id and s.accept(event):
+                        s.put(event)
+            self._subscribers.add(s)
+        return s
+
+    def unsubscribe(self, s):
+        with self._lock:
+            self._subscribers.discard(s)
+
+    def publish(self, type, **data):
+        """Publish the event, or send it to relay if it's set.
+
+        The relay is used by worker processes, it numbers the event and
+        calls dispatch of all the workers.
+        """
+        event = dict(id=None, type=type, time=time.time(), data=data)
+        if self.relay is not None:
+            try:
+                return self.relay(event)
+            except OSError as e:
+                logging.warning('Failed to relay event: %s', e)
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        """Put the event in the queues of subscribers, it's numbered if
+        it has no id."""
+        with self._lock:
+            if event['id'] is None:
+                event['id'] = next(self._counter)
+            self._history.append(event)
+            subscribers = [x for x in self._subscribers if x.accept(event)]
+        for s in subscribers:
+            s.put(event)
+
+
+_bus = EventBus()
+
+
+def get_bus():
+    return _bus
+
+
+def publish(type, **data):
+    get_bus().publish(type, **data)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,46 +1,152 @@
 import glob
+import hashlib
 import logging
 import json
 import os
-import shutil
 import sys
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
-from shlex import split as shell_split
-from subprocess import Popen
-
-from pyarmor.pyarmor import (main as pyarmor_main, pytransform_bootstrap,
-                             get_registration_code, query_keyinfo,
-                             version as pyarmor_version)
-from pyarmor.project import Project
+from shlex import quote as shell_quote, split as shell_split
+
+try:
+    from .history import BuildHistory, pyarmor_version
+    from .locks import file_lock
+    from .manifest import diff_manifest, read_manifest, save_manifest
+    from .events import publish
+    from .matcher import find_sources, glob_escape
+    from .records import RecordIndex
+    from .runtime import CACHE_PATH, REGISTER_FILES, RuntimeCache, \
+        link_tree, make_key
+    from .scheduler import PRIORITY_INTERACTIVE, JobCancelled, \
+        current_job, get_scheduler, phase
+    from .trash import remove as remove_path
+    from .validate import CACHE_FILE as VALIDATE_CACHE_FILE, \
+        SourceValidator, format_errors
+    from .verify import make_checks, run_checks
+    from .workers import run_module
+except Exception:
+    from history import BuildHistory, pyarmor_version
+    from locks import file_lock
+    from manifest import diff_manifest, read_manifest, save_manifest
+    from events import publish
+    from matcher import find_sources, glob_escape
+    from records import RecordIndex
+    from runtime import CACHE_PATH, REGISTER_FILES, RuntimeCache, \
+        link_tree, make_key
+    from scheduler import PRIORITY_INTERACTIVE, JobCancelled, \
+        current_job, get_scheduler, phase
+    from trash import remove as remove_path
+    from validate import CACHE_FILE as VALIDATE_CACHE_FILE, \
+        SourceValidator, format_errors
+    from verify import make_checks, run_checks
+    from workers import run_module
 
 
 def call_pyarmor(args):
+    from pyarmor.pyarmor import main as pyarmor_main
     logging.info('Call pyarmor: %s', args)
     pyarmor_main(args)
 
 
+def update_project(path, data):
+    from pyarmor.project import Project
+    project = Project()
+    project.open(path)
+    project._update(data)
+    project.save(path)
+
+
 def run_pyarmor(args, debug=False):
-    cmd = [sys.executable, '-d'] if debug else [sys.executable]
-    p = Popen(cmd + ['-m', 'pyarmor.pyarmor'] + args)
-    p.wait()
-    if p.returncode != 0:
-        raise RuntimeError('Build project failed (%s)' % p.returncode)
+    rc = run_module('pyarmor.pyarmor', args, debug=debug)
+    if rc != 0:
+        raise RuntimeError('Build project failed (%s)' % rc)
+
+
+# Recheck files in home path after N seconds
+HOME_CHECK_INTERVAL = 2
+
+
+def make_etag(data):
+    s = json.dumps(data, sort_keys=True).encode()
+    return '"%s"' % hashlib.sha1(s).hexdigest()[:24]
+
+
+class HomeCache(object):
+    """Cache data which only changes when files in home path change.
+
+    The signature of cache is name, size and mtime of all the files in
+    home path, it's enough to find new registration files.
+    """
+
+    def __init__(self, homepath, func, interval=HOME_CHECK_INTERVAL):
+        self.homepath = homepath
+        self.interval = interval
+        self._func = func
+        self._value = None
+        self._checked = 0
+
+    def _signature(self):
+        try:
+            return sorted((x.name, x.stat().st_size, x.stat().st_mtime_ns)
+                          for x in os.scandir(self.homepath) if x.is_file())
+        except OSError:
+            return []
+
+    def get(self):
+        """Return (etag, data), home path is checked after interval."""
+        now = time.time()
+        if self._value is None or now - self._checked > self.interval:
+            sig = self._signature()
+            if self._value is None or self._value[0] != sig:
+                data = self._func()
+                self._value = sig, make_etag(data), data
+            self._checked = now
+        return self._value[1:]
+
+    def clear(self):
+        self._value = None
+
+
+def file_signature(filename):
+    try:
+        st = os.stat(filename)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
 
 
 class BaseHandler(object):
 
     data_file = 'index.json'
 
+    # The fields of list records could be used in "list" route, the
+    # value is one of "sort", "prefix", "range", "exact" and "text".
+    # The first 3 kinds are sort keys too
+    list_fields = {}
+
+    # All the routes are serialized by this lock except these ones
+    lock = threading.RLock()
+    unlocked_routes = ()
+
     def __init__(self, config):
         self._config = config
         self.children = []
+        # Increased each time the data file is written, it's saved in
+        # the data file so all the server processes get same value
+        self.generation = 0
+        self._signature = None
 
     def dispatch(self, path, args):
         i = path.find('/')
         if i == -1:
             if hasattr(self, 'do_' + path):
-                return getattr(self, 'do_' + path)(args)
+                if path in self.unlocked_routes:
+                    return getattr(self, 'do_' + path)(args)
+                with self.lock:
+                    return getattr(self, 'do_' + path)(args)
             raise RuntimeError('No route for %s', path)
         else:
             name = path[:i]
@@ -49,6 +155,21 @@ class BaseHandler(object):
                     return handler.dispatch(path[i+1:], args)
             raise RuntimeError('No route for %s', name)
 
+    def get_etag(self, path, args):
+        """Return ETag of the result of this route, None if unknown.
+
+        It's used to reply "not modified" without calling the route.
+        """
+        i = path.find('/')
+        if i == -1:
+            if hasattr(self, 'etag_' + path):
+                return getattr(self, 'etag_' + path)(args)
+        else:
+            name = path[:i]
+            for handler in self.children:
+                if handler.name == name:
+                    return handler.get_etag(path[i+1:], args)
+
     def _check_arg(self, name, value, valids=None, invalids=None, types=None):
         if value in (None, ''):
             raise RuntimeError('Missing argument "%s"' % name)
@@ -75,20 +196,199 @@ class BaseHandler(object):
         filename = os.path.join(path, self.data_file)
         if not os.path.exists(filename):
             if not os.path.exists(path):
-                os.makedirs(path)
-            data = dict(counter=0)
-            data[self.name + 's'] = []
-            with open(filename, 'w') as fp:
-                json.dump(data, fp)
+                os.makedirs(path, exist_ok=True)
+            with file_lock(filename):
+                if not os.path.exists(filename):
+                    data = dict(counter=0, generation=0)
+                    data[self.name + 's'] = []
+                    with open(filename + '.tmp', 'w') as fp:
+                        json.dump(data, fp)
+                    os.replace(filename + '.tmp', filename)
         return filename
 
     def _get_config(self):
         with open(self._config_filename(), 'r') as fp:
             return json.load(fp)
 
-    def _set_config(self, data):
-        with open(self._config_filename(), 'w') as fp:
-            return json.dump(data, fp, indent=2)
+    def _set_config(self, data, changed=(), removed=()):
+        """Save data, update list index by changed and removed records.
+
+        The index is dropped if neither is set, or it's out of date. The
+        caller should hold file lock of data file.
+        """
+        filename = self._config_filename()
+        index = getattr(self, '_index', None)
+        if index and index.signature != file_signature(filename):
+            index = None
+        data['generation'] = data.get('generation', 0) + 1
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(data, fp, indent=2)
+        os.replace(filename + '.tmp', filename)
+        self.generation = data['generation']
+        self._signature = file_signature(filename)
+
+        if index and (changed or removed):
+            for x in removed:
+                index.remove(x['id'])
+            for x in changed:
+                index.add(dict(x))
+            index.signature = self._signature
+        else:
+            self._index = None
+
+    def _get_generation(self):
+        """Return generation of data file, it's read again only if the
+        file is changed, for example, by the other server process."""
+        filename = self._config_filename()
+        signature = file_signature(filename)
+        if signature != self._signature:
+            self.generation = self._get_config().get('generation', 0)
+            self._signature = signature
+        return self.generation
+
+    def _get_index(self):
+        filename = self._config_filename()
+        signature = file_signature(filename)
+        index = getattr(self, '_index', None)
+        if index is None or index.signature != signature:
+            index = RecordIndex(
+                ['id'] + [k for k, v in self.list_fields.items()
+                          if v in ('sort', 'prefix', 'range')],
+                [k for k, v in self.list_fields.items() if v == 'exact'])
+            index.reset(self._get_config()[self.name + 's'])
+            index.signature = signature
+            self._index = index
+        return index
+
+    def _generation_etag(self, args):
+        """Return ETag of the routes which only read the data file.
+
+        It's made of store generation, signature of data file and
+        arguments, so it's got without reading the data file, and all the
+        server processes return same value.
+        """
+        generation = self._get_generation()
+        s = json.dumps([self._signature, args], sort_keys=True).encode()
+        return '"%s-%d-%s"' % (self.name, generation,
+                               hashlib.sha1(s).hexdigest()[:8])
+
+    def _find_record(self, records, args):
+        p = records.get(args.get('id'))
+        if p is None:
+            raise RuntimeError('No %s %s found' % (self.name, args.get('id')))
+        return p
+
+    def _apply(self, items, silent=True):
+        """Apply a list of operations to the records in one transaction.
+
+        Each item is {"op": "new" | "update" | "remove", "args": {...}},
+        it's applied by "_<op>_record" in memory, the data file is written
+        once for all the successful items, then the paths returned by
+        "_remove_record" are removed in parallel.
+
+        Return a list of {"err": 0, "data": record} or {"err": 1, "data":
+        message}, the first error is raised if silent is False.
+
+        The data file is locked while it's read and written, so it's safe
+        for the server processes sharing one data path.
+        """
+        with file_lock(self._config_filename()):
+            results, paths = self._apply_items(items, silent)
+
+        paths = [x for x in paths if x and os.path.exists(x)]
+        if len(paths) > 1:
+            with ThreadPoolExecutor(min(len(paths), 8)) as executor:
+                list(executor.map(remove_path, paths))
+        elif paths:
+            remove_path(paths[0])
+        return results
+
+    def _apply_items(self, items, silent):
+        c = self._get_config()
+        key = self.name + 's'
+        records = dict([(x['id'], x) for x in c[key]])
+        results, changed, removed, paths = [], {}, {}, []
+        created = set()
+        for item in items:
+            try:
+                op, args = item.get('op'), item.get('args') or {}
+                if op == 'new':
+                    p = self._new_record(c, args)
+                    c[key].append(p)
+                    records[p['id']] = p
+                    created.add(p['id'])
+                elif op in ('update', 'remove'):
+                    p = self._find_record(records, args)
+                    if op == 'update':
+                        self._update_record(p, args)
+                    else:
+                        paths.append(self._remove_record(p, args))
+                        del records[p['id']]
+                        removed[p['id']] = p
+                else:
+                    raise RuntimeError('Unknown operation "%s"' % op)
+                if op != 'remove':
+                    changed[p['id']] = p
+                results.append(dict(err=0, data=p))
+            except Exception as e:
+                if not silent:
+                    raise
+                logging.exception('Failed to %s %s', item.get('op'),
+                                  self.name)
+                results.append(dict(err=1, data=str(e)))
+
+        if removed:
+            c[key] = [x for x in c[key] if x['id'] not in removed]
+        if changed or removed:
+            changed = [x for k, x in changed.items() if k not in removed]
+            self._set_config(c, changed=changed,
+                             removed=list(removed.values()))
+            for x in changed:
+                publish('%s.%s' % (self.name, 'created' if x['id'] in created
+                                   else 'changed'),
+                        id=x['id'], record=x, generation=self.generation)
+            for x in removed.values():
+                publish('%s.removed' % self.name, id=x['id'],
+                        generation=self.generation)
+        return results, paths
+
+    def _apply_one(self, op, args):
+        return self._apply([dict(op=op, args=args)], silent=False)[0]['data']
+
+    def _bulk(self, args):
+        items = args.get('items') if isinstance(args, dict) else args
+        if not isinstance(items, list):
+            raise RuntimeError('No items of bulk operations')
+        return self._apply(items)
+
+    def _list(self, args):
+        """Return all the records as before if no paging argument.
+
+        Otherwise return one page of records with "limit" (default is
+        100), "cursor" and "sort" (prefix "-" means descending), the
+        records could be filtered by the fields in list_fields.
+        """
+        filters = [k for k, v in self.list_fields.items() if v != 'sort']
+        if not args or not any([x in args for x in
+                                ['limit', 'cursor', 'sort'] + filters]):
+            return self._get_config()[self.name + 's']
+
+        kinds = {'prefix': 'prefix', 'range': 'ranges', 'exact': 'exact',
+                 'text': 'text'}
+        kwargs = dict([(x, {}) for x in kinds.values()])
+        for name in filters:
+            value = args.get(name)
+            if value in (None, ''):
+                continue
+            kind = self.list_fields[name]
+            if kind == 'range' and not (isinstance(value, list) and
+                                        len(value) == 2):
+                raise RuntimeError('The value of "%s" should be [min, max]'
+                                   % name)
+            kwargs[kinds[kind]][name] = value
+        return self._get_index().query(sort=args.get('sort') or 'id',
+                                       limit=args.get('limit', 100),
+                                       cursor=args.get('cursor'), **kwargs)
 
 
 class RootHandler(BaseHandler):
@@ -101,8 +401,22 @@ class RootHandler(BaseHandler):
             DirectoryHandler(config),
             RuntimeHandler(config)
         ])
+        homepath = os.getenv('PYARMOR_HOME', os.path.join('~', '.pyarmor'))
+        self._version = HomeCache(os.path.expanduser(homepath),
+                                  self._version_info,
+                                  config.get('home_check_interval',
+                                             HOME_CHECK_INTERVAL))
 
     def do_version(self, args=None):
+        return self._version.get()[1]
+
+    def etag_version(self, args=None):
+        return self._version.get()[0]
+
+    def _version_info(self):
+        from pyarmor.pyarmor import (pytransform_bootstrap,
+                                     get_registration_code, query_keyinfo,
+                                     version as pyarmor_version)
         pytransform_bootstrap()
         rcode = get_registration_code()
         return {
@@ -123,6 +437,7 @@ class RootHandler(BaseHandler):
             regfile = os.path.expandvars(regfile).replace('\\', '/')
         cmd_args = ['register', regfile]
         call_pyarmor(cmd_args)
+        self._version.clear()
         return self.do_version()
 
 
@@ -205,14 +520,184 @@ class DirectoryHandler(BaseHandler):
         }
 
 
-class ProjectHandler(BaseHandler):
+class BaseProjectHandler(BaseHandler):
+    """The routes of projects shared by Pyarmor 7 and 8.
+
+    The subclass runs the commands of one Pyarmor version, it provides
+    _build_data, _build_target, _build_temp, _get_bundle, _new_record,
+    _update_record and do_plan.
+    """
 
     data_file = 'index.json'
     temp_id = 0
+    unlocked_routes = 'build', 'diagnose', 'cancel', 'jobs', 'history', \
+        'validate'
+    list_fields = {'title': 'prefix', 'src': 'prefix', 'buildTarget': 'exact'}
 
     def __init__(self, config):
-        super(ProjectHandler, self).__init__(config)
+        super(BaseProjectHandler, self).__init__(config)
         self.name = 'project'
+        self._validator = None
+
+    def _validate(self, args):
+        """Return the list of syntax errors of the scripts to obfuscate.
+
+        The result of each script is cached by its content and Python
+        version, so only the changed scripts are compiled again.
+        """
+        if self._validator is None:
+            self._validator = SourceValidator(
+                os.path.join(self._get_path(), VALIDATE_CACHE_FILE))
+        src = self._format_path(args.get('src'))
+        files = find_sources(src, args.get('include', 'exact'),
+                             args.get('entry', []), args.get('exclude', []))
+        with phase('validate'):
+            return self._validator.validate(src, [x[0] for x in files])
+
+    def _check_sources(self, args):
+        errors = self._validate(args)
+        if errors:
+            job = current_job()
+            if job is not None:
+                job.info['errors'] = errors
+            raise RuntimeError('Syntax errors in %d scripts:\n%s'
+                               % (len(errors), format_errors(errors)))
+
+    def _get_output(self, args):
+        output = self._format_path(args.get('output'))
+        if not output:
+            output = os.path.join(self._format_path(args.get('src')), 'dist')
+        return output
+
+    def _remove_record(self, p, args):
+        logging.info('Remove project: %s', p)
+        if args.get('clean'):
+            return self._get_project_path(p)
+
+    def do_new(self, args):
+        return self._apply_one('new', args)
+
+    def do_update(self, args):
+        return self._apply_one('update', args)
+
+    def do_list(self, args):
+        return self._list(args)
+
+    def etag_list(self, args=None):
+        return self._generation_etag(args)
+
+    def do_remove(self, args):
+        return self._apply_one('remove', args)
+
+    def do_bulk(self, args):
+        return self._bulk(args)
+
+    def do_build(self, args, debug=False):
+        c, p = self._get_project(args, silent=True)
+        output = self._get_output(args)
+        fresh = not os.path.exists(output)
+
+        def build():
+            if p is None:
+                output = self._build_temp(args, debug=debug)
+            else:
+                path = self._get_project_path(p)
+                output = self._build_target(path, args, debug=debug)
+            if args.get('verify') and not debug:
+                return self._verify(output, args)
+            return output
+
+        def done(job):
+            self._history().record(job, args, None if p is None else p['id'])
+
+        try:
+            return get_scheduler().run(
+                'temp' if p is None else p['id'], build,
+                priority=args.get('priority', PRIORITY_INTERACTIVE),
+                timeout=args.get('timeout'), name=args.get('title'),
+                on_done=done)
+        except JobCancelled:
+            if fresh and os.path.exists(output):
+                logging.info('Remove partial output "%s"', output)
+                remove_path(output)
+            raise
+
+    def _verify(self, output, args):
+        """Run entry scripts or bundle in output at the same time."""
+        options = args.get('verify')
+        options = options if isinstance(options, dict) else {}
+        bundle = self._get_bundle(args) if args.get('buildTarget') else None
+        checks = make_checks(output, args.get('entry', []), bundle, options)
+        with phase('verify'):
+            result = run_checks(checks, options.get('timeout'),
+                                options.get('jobs'))
+        job = current_job()
+        if job is not None:
+            job.info['verify'] = result
+        return dict(result, output=output)
+
+    def do_diagnose(self, args):
+        return self.do_build(args, debug=True)
+
+    def do_cancel(self, args):
+        if args.get('job'):
+            return get_scheduler().cancel(job_id=args.get('job'))
+        self._check_arg('id', args.get('id'))
+        return get_scheduler().cancel(key=args.get('id'))
+
+    def do_jobs(self, args=None):
+        return get_scheduler().jobs()
+
+    def do_history(self, args):
+        return self._history().query(
+            project=args.get('id'), since=args.get('since'),
+            until=args.get('until'), state=args.get('state'),
+            pyarmor=args.get('pyarmor'), limit=args.get('limit', 100))
+
+    def _history(self):
+        return BuildHistory(self._get_path())
+
+    def do_validate(self, args):
+        """Compile the scripts to obfuscate, return the errors."""
+        self._build_data(args)
+        return {'errors': self._validate(args)}
+
+    def do_output(self, args):
+        c, p = self._get_project(args)
+        return {
+            'path': self._get_output(p),
+            'bundle': self._get_bundle(p),
+        }
+
+    def do_manifest(self, args):
+        c, p = self._get_project(args)
+        manifest = read_manifest(self._get_project_path(p))
+        if manifest is None:
+            raise RuntimeError('No manifest found, build project %s first'
+                               % p['id'])
+        return manifest
+
+    def do_delta(self, args):
+        manifest = self.do_manifest(args)
+        delta = diff_manifest(args.get('manifest'), manifest)
+        delta['output'] = manifest['output']
+        return delta
+
+    def _get_project(self, args, silent=False):
+        c = self._get_config()
+        n = args.get('id')
+        for p in c['projects']:
+            if n == p['id']:
+                return c, p
+        if silent:
+            return c, None
+        raise RuntimeError('No project %s found' % n)
+
+    def _get_project_path(self, project):
+        return os.path.join(self._get_path(), 'project-%s' % project['id'])
+
+
+class ProjectHandler(BaseProjectHandler):
 
     def _build_data(self, args):
         src = self._format_path(args.get('src'))
@@ -251,19 +736,19 @@ class ProjectHandler(BaseHandler):
 
         include = args.get('include')
         self._check_arg('include', include,
-                        valids=['exact', 'list', 'all'])
+                        valids=['exact', 'imports', 'list', 'all'])
 
+        # The scripts are found by the same matcher of excludes as
+        # Pyarmor 8, not by "prune" and "exclude" of manifest
         manifest = []
         if include == 'exact':
             if entry:
                 manifest.append('include ' + ' '.join(entry))
-        elif include == 'all':
-            manifest.append('global-include *.py')
         else:
-            manifest.append('include *.py')
-        for x in exclude:
-            cmd = 'exclude' if x.endswith('.py') else 'prune'
-            manifest.append('%s %s' % (cmd, x))
+            files = find_sources(src, include, entry, exclude)
+            if files:
+                manifest.append('include ' + ' '.join(
+                    [glob_escape(x[0]) for x in files]))
 
         if licfile and not licfile.endswith('license.lic'):
             licfile = None
@@ -333,15 +818,14 @@ class ProjectHandler(BaseHandler):
             i += 1
         return result
 
-    def _build_target(self, path, args, debug=False):
+    def _build_command(self, path, args):
+        """Return output and the arguments of pyarmor to build."""
         target = args.get('buildTarget')
         self._check_arg('target', target, valids=[0, 1, 2, 3])
 
         src = self._format_path(args.get('src'))
         name = args.get('bundleName')
-        output = self._format_path(args.get('output'))
-        if not output:
-            output = os.path.join(src, 'dist')
+        output = self._get_output(args)
 
         if target:
             cmd_args = ['pack']
@@ -376,10 +860,35 @@ class ProjectHandler(BaseHandler):
         cmd_args.extend(['--output', output])
 
         cmd_args.append(path)
-        run_pyarmor(cmd_args, debug=debug)
+        return output, cmd_args
 
+    def _build_target(self, path, args, debug=False):
+        if args.get('include') in ('imports', 'list', 'all'):
+            # The scripts may be changed since last update
+            update_project(path, self._build_data(args))
+        output, cmd_args = self._build_command(path, args)
+        self._check_sources(args)
+        with phase('build'):
+            run_pyarmor(cmd_args, debug=debug)
+
+        with phase('manifest'):
+            manifest = save_manifest(path, output)
+        job = current_job()
+        if job is not None:
+            job.info.update(files=manifest['count'], size=manifest['size'])
         return output
 
+    def _get_bundle(self, args):
+        target = args.get('buildTarget')
+        name = args.get('bundleName')
+        if not target:
+            return os.path.join(self._get_output(args), name) if name else None
+        if not name:
+            name = os.path.splitext(os.path.basename(args['entry'][0]))[0]
+        if target in (2, 3) and sys.platform == 'win32':
+            name += '.exe'
+        return os.path.join(self._get_output(args), name)
+
     def _build_temp(self, args, debug=False):
         data = self._build_data(args)
 
@@ -387,22 +896,17 @@ class ProjectHandler(BaseHandler):
         path = os.path.join(self._get_path(), name)
 
         if os.path.exists(path):
-            shutil.rmtree(path)
+            remove_path(path)
         os.mkdir(path)
 
         cmd_args = ['init', '--src', data['src'], path]
         call_pyarmor(cmd_args)
 
-        project = Project()
-        project.open(path)
-
-        project._update(data)
-        project.save(path)
+        update_project(path, data)
 
         return self._build_target(path, args, debug=debug)
 
-    def do_new(self, args):
-        c = self._get_config()
+    def _new_record(self, c, args):
         n = c['counter'] + 1
 
         while True:
@@ -424,75 +928,43 @@ class ProjectHandler(BaseHandler):
         cmd_args = ['init', '--src', data['src'], path]
         call_pyarmor(cmd_args)
 
-        project = Project()
-        project.open(path)
-        project._update(data)
-        project.save(path)
-
-        c['projects'].append(args)
+        update_project(path, data)
         c['counter'] = n
-        self._set_config(c)
 
         logging.info('Create project: %s', args)
         return args
 
-    def do_update(self, args):
+    def _update_record(self, p, args):
         data = self._build_data(args)
 
-        c, p = self._get_project(args)
-        p.update(args)
-        self._set_config(c)
-
         path = self._get_project_path(p)
-        project = Project()
-        project.open(path)
-        project._update(data)
-        project.save(path)
+        update_project(path, data)
+        p.update(args)
 
         logging.info('Update project: %s', p)
-        return p
-
-    def do_list(self, args):
-        c = self._get_config()
-        return c['projects']
-
-    def do_remove(self, args):
-        c, p = self._get_project(args)
-
-        if args.get('clean'):
-            path = self._get_project_path(p)
-            if os.path.exists(path):
-                shutil.rmtree(path)
-
-        logging.info('Remove project: %s', p)
-        c['projects'].remove(p)
-        self._set_config(c)
 
-        return p
-
-    def do_build(self, args, debug=False):
+    def do_plan(self, args):
+        self._build_data(args)
         c, p = self._get_project(args, silent=True)
-        if p is None:
-            return self._build_temp(args, debug=debug)
-
-        path = self._get_project_path(p)
-        return self._build_target(path, args, debug=debug)
-
-    def do_diagnose(self, args):
-        return self.do_build(args, debug=True)
+        path = self._get_project_path(p) if p else \
+            os.path.join(self._get_path(), 'project-%s' % self.temp_id)
+        output, cmd_args = self._build_command(path, args)
 
-    def _get_project(self, args, silent=False):
-        c = self._get_config()
-        n = args.get('id')
-        for p in c['projects']:
-            if n == p['id']:
-                return c, p
-        if silent:
-            return c, None
-        raise RuntimeError('No project %s found' % n)
-
-    def _get_project_path(self, project):
-        return os.path.join(self._get_path(), 'project-%s' % project['id'])
+        src = self._format_path(args.get('src'))
+        files = find_sources(src, args.get('include'), args.get('entry', []),
+                             args.get('exclude', []))
+        pyi_options = cmd_args[cmd_args.index('--options') + 1].strip() \
+            if '--options' in cmd_args else ''
+        cmd_args = ['python', '-m', 'pyarmor.pyarmor'] + cmd_args
+        return {
+            'src': src,
+            'output': output,
+            'count': len(files),
+            'size': sum([x[1] for x in files]),
+            'files': [x[0] for x in files[:args.get('limit', 1000)]],
+            'commands': [' '.join([shell_quote(x) for x in cmd_args])],
+            'pyinstaller': pyi_options,
+        }
 
 
 class LicenseHandler(BaseHandler):
@@ -508,13 +980,14 @@ class LicenseHandler(BaseHandler):
         'enablePeriodMode': '--enable-period-mode',
     }
     switch_option_names = 'disableRestrictMode', 'enablePeriodMode'
+    list_fields = {'rcode': 'prefix', 'expired': 'range', 'mac': 'exact',
+                   'harddisk': 'exact', 'ipv4': 'exact', 'extraData': 'text'}
 
     def __init__(self, config):
         super(LicenseHandler, self).__init__(config)
         self.name = 'license'
 
-    def do_new(self, args):
-        c = self._get_config()
+    def _new_record(self, c, args):
         n = c['counter'] + 1
         rcode = args.get('rcode')
         if not rcode:
@@ -523,12 +996,25 @@ class LicenseHandler(BaseHandler):
         args['filename'] = self._create(args)
 
         args['id'] = n
-        c['licenses'].append(args)
         c['counter'] = n
-        self._set_config(c)
-
         return args
 
+    def _update_record(self, p, args):
+        self._create(args, update=True)
+        p.update(args)
+
+    def _remove_record(self, p, args):
+        return os.path.join(self._get_path(), p['rcode'])
+
+    def _find_record(self, records, args):
+        p = records.get(args.get('id'))
+        if p is None or p['rcode'] != args.get('rcode'):
+            raise RuntimeError('No license %s found' % args.get('id'))
+        return p
+
+    def do_new(self, args):
+        return self._apply_one('new', args)
+
     def _create(self, args, update=False):
         path = self._get_path()
         output = self._format_path(args.get('output', path))
@@ -552,38 +1038,19 @@ class LicenseHandler(BaseHandler):
         return filename
 
     def do_update(self, args):
-        c, p = self._get_license(args)
-        p.update(args)
-        self._set_config(c)
-
-        self._create(args, update=True)
-        return p
+        return self._apply_one('update', args)
 
     def do_remove(self, args):
-        c, p = self._get_license(args)
-
-        path = self._get_path()
-        rcode = p['rcode']
-        licpath = os.path.join(path, rcode)
-        if os.path.exists(licpath):
-            shutil.rmtree(licpath)
-
-        c['licenses'].remove(p)
-        self._set_config(c)
-        return p
+        return self._apply_one('remove', args)
 
     def do_list(self, args=None):
-        c = self._get_config()
-        return c['licenses']
+        return self._list(args)
 
-    def _get_license(self, args):
-        c = self._get_config()
-        n = args.get('id')
-        r = args.get('rcode')
-        for p in c['licenses']:
-            if n == p['id'] and r == p['rcode']:
-                return c, p
-        raise RuntimeError('No license %s found' % n)
+    def etag_list(self, args=None):
+        return self._generation_etag(args)
+
+    def do_bulk(self, args):
+        return self._bulk(args)
 
 
 class RuntimeHandler(BaseHandler):
@@ -593,19 +1060,36 @@ class RuntimeHandler(BaseHandler):
         self.name = 'runtime'
 
     def do_new(self, args):
-        cmd_args = ['runtime']
+        options = []
         output = self._format_path(args.get('output', self._get_path()))
-        cmd_args.extend(['--output', output])
 
         for x in ('platform', 'mode', 'with_license'):
             if x in args:
-                cmd_args.append('--%s' % x.replace('_', '-'))
+                options.append('--%s' % x.replace('_', '-'))
                 v = args.get(x)
                 if v:
-                    cmd_args.append(v)
+                    options.append(v)
+
+        # The runtime package is generated once for same options, and
+        # copied to output by hard links
+        homepath = os.path.expanduser(
+            os.getenv('PYARMOR_HOME', os.path.join('~', '.pyarmor')))
+        files = [os.path.join(homepath, x) for x in REGISTER_FILES]
+        licfile = args.get('with_license')
+        if licfile and os.path.isfile(licfile):
+            files.append(licfile)
+        key = make_key({'options': options, 'pyarmor': pyarmor_version()},
+                       files)
+
+        def generate(path):
+            call_pyarmor(['runtime', '--output', path] + options)
+
+        cache = RuntimeCache(os.path.join(self._config['homepath'],
+                                          CACHE_PATH))
+        path = cache.get(key, generate)
 
         logging.info('Generate runtime package at %s', output)
-        call_pyarmor(cmd_args)
+        link_tree(path, output)
 
         return output
 
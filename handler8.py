@@ -4,22 +4,39 @@ import os
 import shutil
 import sys
 
-from json import dumps as json_dumps
-from shlex import split as shell_split
-from subprocess import Popen
+from json import dumps as json_dumps, loads as json_loads
+from shlex import quote as shell_quote, split as shell_split
 from tempfile import TemporaryDirectory
 
-from pyarmor.pyarmor import version as pyarmor_version
-
-from pyarmor.cli.context import Context
-from pyarmor.cli.register import Register
-from pyarmor.cli.__main__ import main_entry as pyarmor_main
-
 
 try:
-    from .handler import BaseHandler, DirectoryHandler
+    from .handler import HOME_CHECK_INTERVAL, BaseHandler, \
+        BaseProjectHandler, DirectoryHandler, HomeCache
+    from .history import pyarmor_version
+    from .imports import split_inputs
+    from .manifest import link_unchanged, read_manifest, save_manifest
+    from .matcher import PathMatcher, find_excluded, find_sources, \
+        glob_escape
+    from .remote import get_pool
+    from .runtime import CACHE_PATH, REGISTER_FILES, RuntimeCache, \
+        find_runtime_package, link_tree, make_key
+    from .scheduler import current_job, phase
+    from .trash import make_staging, remove as remove_path, swap
+    from .workers import run_module
 except Exception:
-    from handler import BaseHandler, DirectoryHandler
+    from handler import HOME_CHECK_INTERVAL, BaseHandler, \
+        BaseProjectHandler, DirectoryHandler, HomeCache
+    from history import pyarmor_version
+    from imports import split_inputs
+    from manifest import link_unchanged, read_manifest, save_manifest
+    from matcher import PathMatcher, find_excluded, find_sources, \
+        glob_escape
+    from remote import get_pool
+    from runtime import CACHE_PATH, REGISTER_FILES, RuntimeCache, \
+        find_runtime_package, link_tree, make_key
+    from scheduler import current_job, phase
+    from trash import make_staging, remove as remove_path, swap
+    from workers import run_module
 
 
 DEFAULT_RESTRICT_FLAG = 1
@@ -44,18 +61,27 @@ def enter_temp_path(func):
 
 def call_pyinstaller(options):
     logging.info('Call PyInstaller: %s', options)
-    p = Popen([sys.executable, '-m', 'PyInstaller'] + options)
-    p.wait()
-    if p.returncode != 0:
-        raise RuntimeError('Build bundle failed (%s)' % p.returncode)
+    rc = run_module('PyInstaller.__main__', options)
+    if rc != 0:
+        raise RuntimeError('Build bundle failed (%s)' % rc)
 
 
 def call_pyarmor(args, homepath=None, debug=False):
+    from pyarmor.cli.__main__ import main_entry as pyarmor_main
     logging.info('Call pyarmor: %s', args)
     extra_opts = ['--home', homepath] + (['-d'] if debug else [])
     pyarmor_main(extra_opts + args)
 
 
+def run_pyarmor(args, homepath=None, debug=False, cwd=None):
+    logging.info('Run pyarmor: %s', args)
+    extra_opts = ['--home', homepath] + (['-d'] if debug else [])
+    rc = run_module('pyarmor.cli.__main__', extra_opts + args, cwd=cwd,
+                    debug=debug)
+    if rc != 0:
+        raise RuntimeError('Build project failed (%s)' % rc)
+
+
 class RootHandler(BaseHandler):
 
     def __init__(self, config):
@@ -65,12 +91,28 @@ class RootHandler(BaseHandler):
             LicenseHandler(config),
             DirectoryHandler(config),
         ])
+        self._version = HomeCache(self.homepath, self._version_info,
+                                  config.get('home_check_interval',
+                                             HOME_CHECK_INTERVAL))
 
     @property
     def homepath(self):
         return self._config['homepath']
 
     def do_version(self, args=None):
+        return self._version.get()[1]
+
+    def etag_version(self, args=None):
+        return self._version.get()[0]
+
+    def do_agents(self, args=None):
+        pool = get_pool()
+        return pool.status() if pool else []
+
+    def _version_info(self):
+        from pyarmor.cli import __VERSION__ as pyarmor_version
+        from pyarmor.cli.context import Context
+        from pyarmor.cli.register import Register
         ctx = Context(self.homepath)
         info = Register(ctx).license_info
         pname = info['product']
@@ -103,6 +145,7 @@ class RootHandler(BaseHandler):
                     cmd_args.append('-u')
         cmd_args.append(filename)
         call_pyarmor(cmd_args, homepath=self._config['homepath'])
+        self._version.clear()
 
         if is_initial:
             regfiles = glob.glob('pyarmor-reg*.zip')
@@ -116,14 +159,7 @@ class RootHandler(BaseHandler):
         return 'OK'
 
 
-class ProjectHandler(BaseHandler):
-
-    data_file = 'index.json'
-    temp_id = 0
-
-    def __init__(self, config):
-        super(ProjectHandler, self).__init__(config)
-        self.name = 'project'
+class ProjectHandler(BaseProjectHandler):
 
     def _build_data(self, args):
         src = self._format_path(args.get('src'))
@@ -162,7 +198,7 @@ class ProjectHandler(BaseHandler):
 
         include = args.get('include')
         self._check_arg('include', include,
-                        valids=['exact', 'list', 'all'])
+                        valids=['exact', 'imports', 'list', 'all'])
 
         if licfile and not licfile.endswith('pyarmor.rkey'):
             licfile = None
@@ -232,21 +268,20 @@ class ProjectHandler(BaseHandler):
             i += 1
         return result
 
-    @enter_temp_path
-    def _build_target(self, path, args, debug=False):
-        homepath = self._config['homepath']
+    def _build_commands(self, args):
+        """Return output and the list of pyarmor arguments to build.
 
+        All the commands except the last one are configurations.
+        """
+        commands = []
         target = args.get('buildTarget')
         self._check_arg('target', target, valids=[0, 1, 2, 3])
 
         src = self._format_path(args.get('src'))
         name = args.get('bundleName')
         entries = args.get('entry', [])
-        entryname = name if name else os.path.splitext(entries[0])[0]
 
-        output = self._format_path(args.get('output'))
-        if not output:
-            output = os.path.join(src, 'dist')
+        output = self._get_output(args)
         cmd_args = ['gen', '--output', output]
 
         if target:
@@ -263,21 +298,7 @@ class ProjectHandler(BaseHandler):
 
             if pyi_options:
                 optdata = 'json::%s' % json_dumps(pyi_options)
-                call_pyarmor(
-                    ['cfg', 'pack:pyi_options', optdata],
-                    homepath=homepath
-                )
-
-            if args.get('cleanOutput', False):
-                if os.path.exists(output):
-                    if len(output) < 4:
-                        # Do not rmtree too short path
-                        raise RuntimeError('Too short output "%s"' % output)
-                    logging.info('Clean output path "%s"', output)
-                    shutil.rmtree(output)
-
-            elif os.path.exists(output):
-                raise RuntimeError('Output "%s" is not empty' % output)
+                commands.append(['cfg', 'pack:pyi_options', optdata])
 
         else:
             if args.get('noRuntime'):
@@ -295,7 +316,7 @@ class ProjectHandler(BaseHandler):
 
         restrict_mode = args.get('restrictMode', DEFAULT_RESTRICT_FLAG)
         if restrict_mode & NO_RESTRICT_FLAG:
-            call_pyarmor(['cfg', 'restrict_module', '0'], homepath=homepath)
+            commands.append(['cfg', 'restrict_module', '0'])
         if restrict_mode & RESTRICT_PACKAGE_FLAG:
             cmd_args.append('--restrict')
         elif restrict_mode & PRIVATE_MODULE_FLAG:
@@ -326,48 +347,200 @@ class ProjectHandler(BaseHandler):
 
         if args.get('plugins'):
             plugins = ' '.join(args.get('plugins'))
-            call_pyarmor(['cfg', 'plugins', '+', plugins], homepath=homepath)
+            commands.append(['cfg', 'plugins', '+', plugins])
 
         include = args.get('include', 'exact')
         excludes = args.get('exclude', [])
 
-        for x in excludes:
-            cmd_args.extend(['--exclude', os.path.join('*', x)])
+        for x in find_excluded(src, excludes):
+            cmd_args.extend(['--exclude', glob_escape(os.path.join(src, x))])
 
         if include == 'exact':
             cmd_args.extend([os.path.join(src, x) for x in entries])
+        elif include == 'imports':
+            files = find_sources(src, include, entries, excludes)
+            paths, skips = split_inputs(src, [x[0] for x in files], excludes)
+            if name and not target:
+                skips.extend([x.name for x in os.scandir(src)
+                              if x.name not in paths and (
+                                  x.is_dir() or x.name.endswith('.py'))])
+                paths = [src]
+            cmd_args.append('-r')
+            for x in skips:
+                cmd_args.extend(['--exclude',
+                                 glob_escape(os.path.join(src, x))])
+            cmd_args.extend([os.path.join(src, x) for x in paths])
         elif name and not target:
             if include == 'all':
                 cmd_args.append('-r')
             cmd_args.append(src)
         else:
+            matcher = PathMatcher(excludes)
             inputs = [(x.is_file(), x.path) for x in os.scandir(src)
-                      if x not in excludes and not x.name.startswith('.')]
+                      if not (x.name.startswith('.') or matcher.match(x.name))]
             if include == 'all':
                 cmd_args.append('-r')
                 cmd_args.extend([b for a, b in inputs if not a])
             cmd_args.extend([b for a, b in inputs if a and b.endswith('.py')])
 
-        call_pyarmor(cmd_args, homepath=homepath, debug=debug)
+        commands.append(cmd_args)
+        return output, commands
+
+    def _build_target(self, path, args, debug=False):
+        target = args.get('buildTarget')
+        output, commands = self._build_commands(args)
+        self._check_sources(args)
+
+        # Build in staging path and replace the old output at the end,
+        # so the old output is there if the build fails
+        staging = None
+        if target:
+            if args.get('cleanOutput', False):
+                if os.path.exists(output):
+                    if len(output) < 4:
+                        # Do not remove too short path
+                        raise RuntimeError('Too short output "%s"' % output)
+                    staging = make_staging(output)
+                    cmd_args = commands[-1]
+                    cmd_args[cmd_args.index('--output') + 1] = staging
+
+            elif os.path.exists(output):
+                raise RuntimeError('Output "%s" is not empty' % output)
+
+        pool = get_pool()
+        try:
+            if pool and not debug:
+                rtpath = self._build_remote(pool, staging or output, args)
+            else:
+                rtpath = self._build_output(staging or output, commands,
+                                            args, debug=debug)
+        except Exception:
+            if staging:
+                remove_path(staging)
+            raise
+
+        if staging:
+            with phase('swap'):
+                link_unchanged(staging, read_manifest(path))
+                logging.info('Replace output path "%s"', output)
+                swap(staging, output)
+
+        with phase('manifest'):
+            manifest = save_manifest(path, output)
+        job = current_job()
+        if job is not None:
+            job.info.update(files=manifest['count'], size=manifest['size'],
+                            runtime=rtpath)
+        return output
+
+    def _build_output(self, output, commands, args, debug=False):
+        """Run pyarmor commands, return runtime path if it's cached."""
+        homepath = self._config['homepath']
+
+        # Local configurations are saved in the current path, so each
+        # build runs in its own temporary path
+        runtime = None
+        with TemporaryDirectory() as cwd:
+            with phase('config'):
+                for cmd_args in commands[:-1]:
+                    run_pyarmor(cmd_args, homepath=homepath, cwd=cwd)
+            cmd_args = commands[-1]
+            options = self._runtime_options(args, commands)
+            if options is not None:
+                with phase('runtime'):
+                    runtime = self._get_runtime(options, cwd)
+                cmd_args = cmd_args[:1] + ['--use-runtime', runtime] + \
+                    cmd_args[1:]
+            with phase('gen'):
+                run_pyarmor(cmd_args, homepath=homepath, debug=debug,
+                            cwd=cwd)
+
+        rtpath = None
+        if runtime:
+            pkg = find_runtime_package(runtime)
+            rtpath = os.path.join(output, os.path.basename(pkg))
+            link_tree(pkg, rtpath)
+
+        self._copy_license(output, args, rtpath)
+        return rtpath
+
+    def _build_remote(self, pool, output, args):
+        """Build in agents, the license file is copied here."""
+        src = self._format_path(args.get('src'))
+        project = dict(args, cleanOutput=False)
+        for x in ('id', 'name', 'path', 'output'):
+            project.pop(x, None)
+        # Agents use outer key, no license file there
+        if project.get('licenseFile') not in ('true', 'false', 'outer',
+                                              None, ''):
+            project['licenseFile'] = 'outer'
+
+        with phase('remote'):
+            url = pool.build(src, output, project, args.get('exclude', []),
+                             skips=[self._get_output(args), output])
+        logging.info('Build output is from agent %s', url)
+        self._copy_license(output, args, None)
+
+    def _copy_license(self, output, args, rtpath):
+        target = args.get('buildTarget')
+        name = args.get('bundleName')
+        entries = args.get('entry', [])
+        entryname = name if name else os.path.splitext(entries[0])[0]
+        licfile = args.get('licenseFile')
 
         if isinstance(licfile, str) and os.path.exists(licfile):
             licpath = os.path.join(output, entryname if target == 1 else '')
-            if target not in (2, 3):
-                def is_runtime_package(p):
-                    names = os.listdir(p)
-                    return '__init__.py' in names and any([
-                        x.startswith('pyarmor_runtime.') for x in names])
-
-                for x in os.scandir(licpath):
-                    if x.is_dir() and x.name.startswith('pyarmor_runtime_') \
-                       and is_runtime_package(x.path):
-                        licpath = x.path
-                        break
-                else:
+            if rtpath:
+                # Never write to the files linked to runtime cache
+                licpath = os.path.join(rtpath, os.path.basename(licfile))
+                if os.path.lexists(licpath):
+                    os.remove(licpath)
+            elif target not in (2, 3):
+                licpath = find_runtime_package(licpath)
+                if licpath is None:
                     raise RuntimeError('no found runtime package')
             shutil.copy2(licfile, licpath)
 
-        return output
+    def _runtime_options(self, args, commands):
+        """Return options of "gen runtime", None if it can't be cached.
+
+        Only the runtime package of plain scripts is cached, the bundle
+        and package (-i) have their own layout.
+        """
+        if args.get('buildTarget') or args.get('bundleName') or \
+           args.get('noRuntime') or args.get('bccMode') or len(commands) > 1:
+            return None
+        gen = commands[-1]
+        options = []
+        for i, x in enumerate(gen):
+            if x in ('--outer', '--enable-themida'):
+                options.append(x)
+            elif x == '--platform':
+                options.extend(gen[i:i+2])
+        return options
+
+    def _get_runtime(self, options, cwd):
+        homepath = self._config['homepath']
+        key = make_key({'options': options, 'pyarmor': pyarmor_version()},
+                       [os.path.join(homepath, x) for x in REGISTER_FILES])
+
+        def generate(path):
+            run_pyarmor(['gen', 'runtime', '--output', path] + options,
+                        homepath=homepath, cwd=cwd)
+
+        cache = RuntimeCache(os.path.join(homepath, CACHE_PATH))
+        return cache.get(key, generate)
+
+    def _get_bundle(self, args):
+        target = args.get('buildTarget')
+        if not target:
+            return None
+        name = args.get('bundleName')
+        if not name:
+            name = os.path.splitext(os.path.basename(args['entry'][0]))[0]
+        if target in (2, 3) and sys.platform == 'win32':
+            name += '.exe'
+        return os.path.join(self._get_output(args), name)
 
     def _build_temp(self, args, debug=False):
         self._build_data(args)
@@ -376,13 +549,12 @@ class ProjectHandler(BaseHandler):
         path = os.path.join(self._get_path(), name)
 
         if os.path.exists(path):
-            shutil.rmtree(path)
+            remove_path(path)
         os.mkdir(path)
 
         return self._build_target(path, args, debug=debug)
 
-    def do_new(self, args):
-        c = self._get_config()
+    def _new_record(self, c, args):
         n = c['counter'] + 1
 
         while True:
@@ -400,65 +572,36 @@ class ProjectHandler(BaseHandler):
         if not args.get('title', ''):
             args['title'] = os.path.basename(args.get('src'))
         self._build_data(args)
-
-        c['projects'].append(args)
         c['counter'] = n
-        self._set_config(c)
 
         logging.info('Create project: %s', args)
         return args
 
-    def do_update(self, args):
+    def _update_record(self, p, args):
         self._build_data(args)
-
-        c, p = self._get_project(args)
         p.update(args)
-        self._set_config(c)
-
         logging.info('Update project: %s', p)
-        return p
-
-    def do_list(self, args):
-        c = self._get_config()
-        return c['projects']
-
-    def do_remove(self, args):
-        c, p = self._get_project(args)
-
-        if args.get('clean'):
-            path = self._get_project_path(p)
-            if os.path.exists(path):
-                shutil.rmtree(path)
-
-        logging.info('Remove project: %s', p)
-        c['projects'].remove(p)
-        self._set_config(c)
-
-        return p
-
-    def do_build(self, args, debug=False):
-        c, p = self._get_project(args, silent=True)
-        if p is None:
-            return self._build_temp(args, debug=debug)
-
-        path = self._get_project_path(p)
-        return self._build_target(path, args, debug=debug)
 
-    def do_diagnose(self, args):
-        return self.do_build(args, debug=True)
-
-    def _get_project(self, args, silent=False):
-        c = self._get_config()
-        n = args.get('id')
-        for p in c['projects']:
-            if n == p['id']:
-                return c, p
-        if silent:
-            return c, None
-        raise RuntimeError('No project %s found' % n)
+    def do_plan(self, args):
+        self._build_data(args)
+        output, commands = self._build_commands(args)
 
-    def _get_project_path(self, project):
-        return os.path.join(self._get_path(), 'project-%s' % project['id'])
+        src = self._format_path(args.get('src'))
+        files = find_sources(src, args.get('include'), args.get('entry', []),
+                             args.get('exclude', []))
+        pyi_options = [json_loads(x[2][len('json::'):]) for x in commands
+                       if x[:2] == ['cfg', 'pack:pyi_options']]
+        prefix = ['pyarmor', '--home', self._config['homepath']]
+        return {
+            'src': src,
+            'output': output,
+            'count': len(files),
+            'size': sum([x[1] for x in files]),
+            'files': [x[0] for x in files[:args.get('limit', 1000)]],
+            'commands': [' '.join([shell_quote(x) for x in prefix + cmd])
+                         for cmd in commands],
+            'pyinstaller': ' '.join(pyi_options[0]) if pyi_options else '',
+        }
 
 
 class LicenseHandler(BaseHandler):
@@ -472,13 +615,14 @@ class LicenseHandler(BaseHandler):
         'extraData': '--bind-data',
     }
     switch_option_names = 'disableRestrictMode', 'enablePeriodMode'
+    list_fields = {'rcode': 'prefix', 'expired': 'range', 'mac': 'exact',
+                   'harddisk': 'exact', 'ipv4': 'exact', 'extraData': 'text'}
 
     def __init__(self, config):
         super(LicenseHandler, self).__init__(config)
         self.name = 'license'
 
-    def do_new(self, args):
-        c = self._get_config()
+    def _new_record(self, c, args):
         n = c['counter'] + 1
         rcode = args.get('rcode')
         if not rcode:
@@ -487,12 +631,25 @@ class LicenseHandler(BaseHandler):
         args['filename'] = self._create(args)
 
         args['id'] = n
-        c['licenses'].append(args)
         c['counter'] = n
-        self._set_config(c)
-
         return args
 
+    def _update_record(self, p, args):
+        self._create(args, update=True)
+        p.update(args)
+
+    def _remove_record(self, p, args):
+        return os.path.join(self._get_path(), p['rcode'])
+
+    def _find_record(self, records, args):
+        p = records.get(args.get('id'))
+        if p is None or p['rcode'] != args.get('rcode'):
+            raise RuntimeError('No license %s found' % args.get('id'))
+        return p
+
+    def do_new(self, args):
+        return self._apply_one('new', args)
+
     def _create(self, args, update=False):
         path = self._get_path()
         output = self._format_path(args.get('output', path))
@@ -521,38 +678,19 @@ class LicenseHandler(BaseHandler):
         return filename
 
     def do_update(self, args):
-        c, p = self._get_license(args)
-        p.update(args)
-        self._set_config(c)
-
-        self._create(args, update=True)
-        return p
+        return self._apply_one('update', args)
 
     def do_remove(self, args):
-        c, p = self._get_license(args)
+        return self._apply_one('remove', args)
 
-        path = self._get_path()
-        rcode = p['rcode']
-        licpath = os.path.join(path, rcode)
-        if os.path.exists(licpath):
-            shutil.rmtree(licpath)
+    def do_list(self, args=None):
+        return self._list(args)
 
-        c['licenses'].remove(p)
-        self._set_config(c)
-        return p
+    def etag_list(self, args=None):
+        return self._generation_etag(args)
 
-    def do_list(self, args=None):
-        c = self._get_config()
-        return c['licenses']
-
-    def _get_license(self, args):
-        c = self._get_config()
-        n = args.get('id')
-        r = args.get('rcode')
-        for p in c['licenses']:
-            if n == p['id'] and r == p['rcode']:
-                return c, p
-        raise RuntimeError('No license %s found' % n)
+    def do_bulk(self, args):
+        return self._bulk(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+
+try:
+    from .locks import file_lock
+except Exception:
+    from locks import file_lock
+
+HISTORY_FILE = 'history.jsonl'
+
+# The log is renamed to "history.jsonl.1" once it's larger than N bytes,
+# the older one is removed, so the history of builds is bounded
+MAX_HISTORY_SIZE = 4 * 1024 * 1024
+
+# These arguments don't change the build result
+IGNORED_OPTIONS = 'id', 'name', 'title', 'path', 'priority', 'timeout'
+
+
+def pyarmor_version():
+    try:
+        from importlib.metadata import version
+        return version('pyarmor')
+    except Exception:
+        return ''
+
+
+def options_digest(args):
+    data = dict([(k, v) for k, v in args.items()
+                 if k not in IGNORED_OPTIONS])
+    s = json.dumps(data, sort_keys=True).encode()
+    return hashlib.sha1(s).hexdigest()[:12]
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values by nearest rank.
+
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+    10
+    """
+    if not values:
+        return 0
+    k = max(int(len(values) * p / 100.0 + 0.999999) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+class BuildHistory(object):
+    """Append one json line for each build to a log file.
+
+    The log is rotated once it's larger than max_size, only the records
+    of the current and the previous log are kept.
+
+    >>> import tempfile
+    >>> h = BuildHistory(tempfile.mkdtemp(), max_size=20)
+    >>> for i in range(10):
+    ...     h.append({'n': i})
+    >>> [x['n'] for x in h.read()]
+    [6, 7, 8, 9]
+    """
+
+    def __init__(self, path, max_size=MAX_HISTORY_SIZE):
+        self.filename = os.path.join(path, HISTORY_FILE)
+        self.max_size = max_size
+
+    def record(self, job, args, project=None):
+        """Make a record of finished job and append it to the log."""
+        created = job.started or job.finished
+        phases = dict([(k, round(v, 3)) for k, v in job.phases.items()])
+        phases['queue'] = round(created - job.created, 3)
+        rec = {
+            'time': round(job.created, 3),
+            'project': project,
+            'target': args.get('buildTarget'),
+            'digest': options_digest(args),
+            'state': job.state,
+            'duration': round(job.finished - created, 3),
+            'phases': phases,
+            'files': job.info.get('files'),
+            'size': job.info.get('size'),
+            'runtime': job.info.get('runtime'),
+            'pyarmor': pyarmor_version(),
+            'error': job.error,
+        }
+        try:
+            self.append(rec)
+        except Exception:
+            logging.exception('Failed to write build history')
+        return rec
+
+    def append(self, rec):
+        line = json.dumps(rec, separators=(',', ':')) + '\n'
+        with file_lock(self.filename):
+            try:
+                size = os.path.getsize(self.filename)
+            except OSError:
+                size = 0
+            if size and size + len(line) > self.max_size:
+                os.replace(self.filename, self.filename + '.1')
+            with open(self.filename, 'a') as f:
+                f.write(line)
+
+    def read(self):
+        """Yield the records of the previous and the current log."""
+        for filename in (self.filename + '.1', self.filename):
+            if not os.path.exists(filename):
+                continue
+            with open(filename, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def query(self, project=None, since=None, until=None, state=None,
+              pyarmor=None, limit=100):
+        """Return the latest records and statistics of each project.
+
+        Statistics are calculated from all the matched records, only
+        the latest `limit` records are returned.
+        """
+        records = []
+        for rec in self.read():
+            if project is not None and rec['project'] != project:
+                continue
+            if since and rec['time'] < since:
+                continue
+            if until and rec['time'] >= until:
+                continue
+            if state and rec['state'] != state:
+                continue
+            if pyarmor and rec['pyarmor'] != pyarmor:
+                continue
+            records.append(rec)
+
+        groups = {}
+        for rec in records:
+            groups.setdefault(str(rec['project']), []).append(rec)
+
+        stats = {}
+        for key, items in groups.items():
+            durations = sorted([x['duration'] for x in items
+                                if x['state'] == 'finished'])
+            sizes = [x['size'] for x in items if x['size'] is not None]
+            stats[key] = {
+                'count': len(items),
+                'failed': len([x for x in items if x['state'] == 'failed']),
+                'cancelled': len([x for x in items
+                                  if x['state'] == 'cancelled']),
+                'p50': percentile(durations, 50),
+                'p95': percentile(durations, 95),
+                'mean': round(sum(durations) / len(durations), 3)
+                if durations else 0,
+                'size': sizes[-1] if sizes else None,
+            }
+
+        return {
+            'total': len(records),
+            'records': records[::-1][:limit],
+            'stats': stats,
+        }
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,186 @@
+import itertools
+import json
+import logging
+import selectors
+import socket
+import threading
+
+# Wait N seconds for the replies of all the workers
+CALL_TIMEOUT = 5
+
+# Drop the worker if it doesn't read messages in N seconds
+SEND_TIMEOUT = 5
+
+
+def _encode(msg):
+    return (json.dumps(msg) + '\n').encode()
+
+
+class Hub(object):
+    """Relay messages between worker processes, it runs in supervisor.
+
+    Each worker is connected by a socket pair, the messages are JSON
+    lines. An event is numbered here and sent to all the workers, so
+    all of them have same events. A call is sent to all the workers, and
+    their results are sent back to the caller as one list.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._buffers = {}
+        self._events = itertools.count(1)
+        self._calls = {}
+        self._call_ids = itertools.count(1)
+
+    def connect(self):
+        """Return the socket passed to a new worker."""
+        sock, child = socket.socketpair()
+        sock.settimeout(SEND_TIMEOUT)
+        self._buffers[sock] = b''
+        self._selector.register(sock, selectors.EVENT_READ)
+        return sock, child
+
+    def close(self, sock):
+        if sock not in self._buffers:
+            return
+        self._selector.unregister(sock)
+        del self._buffers[sock]
+        sock.close()
+        for rid, call in list(self._calls.items()):
+            if call['sock'] is sock:
+                del self._calls[rid]
+            else:
+                call['waiting'].discard(sock)
+                self._reply(rid)
+
+    def _send(self, sock, msg):
+        try:
+            sock.sendall(_encode(msg))
+        except OSError as e:
+            logging.warning('Drop worker connection: %s', e)
+            self.close(sock)
+
+    def _broadcast(self, msg):
+        for sock in list(self._buffers):
+            self._send(sock, msg)
+
+    def _reply(self, rid):
+        call = self._calls.get(rid)
+        if call and not call['waiting']:
+            del self._calls[rid]
+            self._send(call['sock'], dict(type='reply', rid=call['rid'],
+                                          results=call['results']))
+
+    def _handle(self, sock, msg):
+        kind = msg.get('type')
+        if kind == 'event':
+            msg['event']['id'] = next(self._events)
+            self._broadcast(msg)
+        elif kind == 'call':
+            rid = next(self._call_ids)
+            self._calls[rid] = dict(sock=sock, rid=msg['rid'], results=[],
+                                    waiting=set(self._buffers))
+            self._broadcast(dict(msg, rid=rid))
+        elif kind == 'reply':
+            call = self._calls.get(msg['rid'])
+            if call and sock in call['waiting']:
+                call['waiting'].discard(sock)
+                call['results'].append(msg['result'])
+                self._reply(msg['rid'])
+
+    def poll(self, timeout):
+        """Wait messages at most timeout seconds and handle them."""
+        for key, mask in self._selector.select(timeout):
+            sock = key.fileobj
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                self.close(sock)
+                continue
+            lines = (self._buffers[sock] + data).split(b'\n')
+            self._buffers[sock] = lines.pop()
+            for line in lines:
+                self._handle(sock, json.loads(line.decode()))
+
+
+class HubClient(object):
+    """Connect worker process to the hub in supervisor.
+
+    The handlers of calls are {op: func(args)}, each call is handled in
+    a new thread. The received events are passed to on_event.
+    """
+
+    def __init__(self, sock, on_event=None):
+        self.handlers = {}
+        self.on_event = on_event
+        self._sock = sock
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._waiting = {}
+
+    def start(self):
+        thread = threading.Thread(target=self._read, name='hub-client')
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, msg):
+        with self._lock:
+            self._sock.sendall(_encode(msg))
+
+    def publish(self, event):
+        self._send(dict(type='event', event=event))
+
+    def call(self, op, args=None, timeout=CALL_TIMEOUT):
+        """Call op in all the workers, return the list of results."""
+        rid = next(self._counter)
+        done = threading.Event()
+        self._waiting[rid] = done
+        try:
+            self._send(dict(type='call', rid=rid, op=op, args=args))
+            if not done.wait(timeout):
+                raise RuntimeError('No reply of "%s" from workers' % op)
+            return done.results
+        finally:
+            self._waiting.pop(rid, None)
+
+    def _handle_call(self, msg):
+        try:
+            result = self.handlers[msg['op']](msg['args'])
+        except Exception:
+            logging.exception('Failed to handle call "%s"', msg['op'])
+            result = None
+        try:
+            self._send(dict(type='reply', rid=msg['rid'], result=result))
+        except OSError:
+            pass
+
+    def _read(self):
+        buf = b''
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                logging.warning('Connection to supervisor is closed')
+                break
+            lines = (buf + data).split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                msg = json.loads(line.decode())
+                kind = msg.get('type')
+                if kind == 'event' and self.on_event:
+                    self.on_event(msg['event'])
+                elif kind == 'call':
+                    thread = threading.Thread(target=self._handle_call,
+                                              args=(msg,))
+                    thread.daemon = True
+                    thread.start()
+                elif kind == 'reply':
+                    done = self._waiting.get(msg['rid'])
+                    if done:
+                        done.results = [x for x in msg['results']
+                                        if x is not None]
+                        done.set()
@@ -0,0 +1,167 @@
+import ast
+import os
+import threading
+
+try:
+    from .manifest import hash_file
+    from .matcher import PathMatcher
+except Exception:
+    from manifest import hash_file
+    from matcher import PathMatcher
+
+# Drop the cache of import sets if it has more entries
+MAX_ENTRIES = 50000
+
+
+def parse_imports(source, filename='<unknown>'):
+    """Return the list of (level, module, names) imported by the source.
+
+    All the import statements are collected, including the ones in the
+    functions and try blocks. The dynamic imports are not found.
+
+    >>> parse_imports('import a.b, c\\nfrom .d import e\\nfrom . import f')
+    [(0, 'a.b', ()), (0, 'c', ()), (1, 'd', ('e',)), (1, '', ('f',))]
+    """
+    result = []
+    for node in ast.walk(ast.parse(source, filename)):
+        if isinstance(node, ast.Import):
+            result.extend([(0, x.name, ()) for x in node.names])
+        elif isinstance(node, ast.ImportFrom):
+            result.append((node.level, node.module or '',
+                           tuple([x.name for x in node.names])))
+    return result
+
+
+class ImportGraph(object):
+    """Find the local modules reachable from the entry scripts.
+
+    The import set of each module is cached by its content hash, the
+    hash is reused if the size and mtime of the file are same as last
+    time.
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self._imports = {}
+        self._lock = threading.Lock()
+
+    def imports(self, filename):
+        st = os.stat(filename)
+        with self._lock:
+            item = self._hashes.get(filename)
+        if not item or item[:2] != (st.st_size, st.st_mtime_ns):
+            item = st.st_size, st.st_mtime_ns, hash_file(filename)
+        with self._lock:
+            self._hashes[filename] = item
+            result = self._imports.get(item[2])
+        if result is None:
+            with open(filename, 'rb') as f:
+                try:
+                    result = parse_imports(f.read(), filename)
+                except (SyntaxError, ValueError):
+                    result = []
+            with self._lock:
+                if len(self._imports) > MAX_ENTRIES:
+                    self._imports.clear()
+                    self._hashes.clear()
+                self._imports[item[2]] = result
+        return result
+
+    def reachable(self, src, entries, excludes=()):
+        """Return the list of (relpath, size) of reachable modules.
+
+        The absolute imports are resolved from src and the paths of
+        entry scripts, the packages of each module are reachable too.
+        The scripts match excludes are ignored.
+        """
+        matcher = PathMatcher(excludes)
+        entries = [x.replace('\\', '/') for x in entries]
+        roots = sorted(set([''] + [os.path.dirname(x) for x in entries]))
+
+        def find(parts, bases):
+            """Return the relative paths of module and its packages."""
+            for base in bases:
+                base = base.split('/') if base else []
+                name = '/'.join(base + parts)
+                for x in (name + '.py', name + '/__init__.py'):
+                    if parts and os.path.isfile(os.path.join(src, x)):
+                        return [x] + ['/'.join(base + parts[:i] +
+                                               ['__init__.py'])
+                                      for i in range(1, len(parts))]
+            return []
+
+        result = {}
+        queue = list(entries)
+        while queue:
+            name = queue.pop()
+            filename = os.path.join(src, name)
+            if name in result or matcher.match(name) or \
+               not os.path.isfile(filename):
+                continue
+            result[name] = os.path.getsize(filename)
+
+            package = name.split('/')[:-1]
+            for level, module, names in self.imports(filename):
+                if level:
+                    if level - 1 > len(package):
+                        continue
+                    parts = package[:len(package) - level + 1]
+                    bases = ['']
+                else:
+                    parts, bases = [], roots
+                parts = parts + (module.split('.') if module else [])
+                queue.extend(find(parts, bases))
+                for x in names:
+                    queue.extend(find(parts + [x], bases))
+        return sorted(result.items())
+
+
+_graph = ImportGraph()
+
+
+def find_reachable(src, entries, excludes=()):
+    return _graph.reachable(src, entries, excludes)
+
+
+def split_inputs(src, files, excludes=()):
+    """Return top level items in src to obfuscate recursively, and the
+    relative paths in them which have no reachable module.
+
+    >>> import tempfile
+    >>> src = tempfile.mkdtemp()
+    >>> for x in ('main.py', 'a/__init__.py', 'a/b.py', 'a/c/d.py'):
+    ...     os.makedirs(os.path.dirname(os.path.join(src, x)) or src,
+    ...                 exist_ok=True)
+    ...     open(os.path.join(src, x), 'w').close()
+    >>> split_inputs(src, ['main.py', 'a/__init__.py'])
+    (['a', 'main.py'], ['a/b.py', 'a/c'])
+    """
+    matcher = PathMatcher(excludes)
+    reachable = set(files)
+    paths = set([x.split('/')[0] for x in files])
+    dirs = set()
+    for x in files:
+        parts = x.split('/')[:-1]
+        dirs.update(['/'.join(parts[:i]) for i in range(1, len(parts) + 1)])
+
+    result = []
+    for top in sorted(paths):
+        if top not in dirs:
+            continue
+        for root, dirnames, filenames in os.walk(os.path.join(src, top)):
+            prefix = os.path.relpath(root, src).replace('\\', '/') + '/'
+            for x in sorted(dirnames):
+                name = prefix + x
+                if not (x.startswith('.') or matcher.match(name)) and \
+                   name not in dirs:
+                    result.append(name)
+            dirnames[:] = [x for x in dirnames if prefix + x in dirs]
+            result.extend([prefix + x for x in sorted(filenames)
+                           if x.endswith('.py') and prefix + x not in
+                           reachable and not matcher.match(prefix + x)])
+    return sorted(paths), sorted(result)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
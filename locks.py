@@ -0,0 +1,112 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+LOCK_SUFFIX = '.lock'
+
+
+def _lock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        # msvcrt.locking only waits 10 seconds
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                time.sleep(0.1)
+
+
+def _try_lock(fd):
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(filename):
+    """Hold exclusive lock of filename while it's read and written.
+
+    The lock is "filename.lock", it works between threads and processes,
+    all the server processes sharing one data path use it to serialize
+    writes.
+
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'index.json')
+    >>> with file_lock(filename):
+    ...     os.path.exists(filename + LOCK_SUFFIX)
+    True
+    """
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename + LOCK_SUFFIX, flags, 0o644)
+    try:
+        _lock(fd)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+class Slots(object):
+    """Slots shared by the server processes using one data path.
+
+    Each slot is a lock file "name-N.lock" in path, it's taken by holding
+    the lock, so the slots of a crashed process are freed by the system.
+
+    >>> import tempfile
+    >>> slots = Slots(tempfile.mkdtemp())
+    >>> fd = slots.acquire('build', 1)
+    >>> slots.acquire('build', 1) is None
+    True
+    >>> slots.release(fd)
+    >>> slots.release(slots.acquire('build', 1))
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def acquire(self, name, count):
+        """Return the handle of one free slot, None if all are taken."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        for i in range(count):
+            filename = os.path.join(self.path, '%s-%d%s' % (
+                name, i, LOCK_SUFFIX))
+            fd = os.open(filename, flags, 0o644)
+            if _try_lock(fd):
+                return fd
+            os.close(fd)
+
+    def release(self, fd):
+        if fd is not None:
+            _unlock(fd)
+            os.close(fd)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
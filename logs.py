@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import random
+import sys
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+TEXT_FORMAT = '%(levelname)-8s %(message)s'
+
+# The extra fields of log record written by JSON formatter
+FIELDS = 'request', 'method', 'route', 'status', 'duration', 'payload'
+
+# Truncate string longer than this, and list or dict with more items
+MAX_STRING = 200
+MAX_ITEMS = 20
+
+# Drop the log records if there are so many in the queue
+QUEUE_SIZE = 10000
+
+_local = threading.local()
+_listener = None
+_sample_rate = 0.0
+
+
+def truncate(value, depth=3):
+    """Return a copy of value with large fields truncated.
+
+    >>> len(truncate('x' * 1000))
+    115
+    >>> truncate({'a': list(range(25))}, depth=2)
+    {'a': [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, \
+18, 19, '...(25 items)']}
+    """
+    if isinstance(value, str):
+        if len(value) > MAX_STRING:
+            return '%s...(%d chars)' % (value[:MAX_STRING // 2], len(value))
+        return value
+    if isinstance(value, bytes):
+        return '(%d bytes)' % len(value)
+    if isinstance(value, (list, tuple)):
+        if depth == 0:
+            return '(%d items)' % len(value)
+        items = [truncate(x, depth - 1) for x in value[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            items.append('...(%d items)' % len(value))
+        return items
+    if isinstance(value, dict):
+        if depth == 0:
+            return '(%d items)' % len(value)
+        items = list(value.items())
+        result = dict([(k, truncate(v, depth - 1))
+                       for k, v in items[:MAX_ITEMS]])
+        if len(items) > MAX_ITEMS:
+            result['...'] = '(%d items)' % len(items)
+        return result
+    return value
+
+
+def set_request(rid):
+    """Set request id of the current thread, it's added to log records."""
+    _local.request = rid
+
+
+def sampled():
+    """Return True if the payload of this request should be logged."""
+    return _sample_rate > 0 and random.random() < _sample_rate
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for k in FIELDS:
+            v = getattr(record, k, None)
+            if v is not None:
+                data[k] = v
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class AsyncHandler(QueueHandler):
+    """Put log records into queue, they're formatted and written by
+    the background thread.
+
+    The arguments of record are truncated copies, so the record could be
+    formatted later. The record is dropped if the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        if not hasattr(record, 'request'):
+            record.request = getattr(_local, 'request', None)
+        if record.args:
+            args = record.args
+            record.args = truncate(args, 2) if isinstance(args, dict) \
+                else tuple(truncate(x, 2) for x in args)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            AsyncHandler.dropped += 1
+
+
+class DroppedFilter(logging.Filter):
+
+    def filter(self, record):
+        n = AsyncHandler.dropped
+        if n:
+            AsyncHandler.dropped = 0
+            sys.stderr.write('WARNING  %d log records are dropped\n' % n)
+        return True
+
+
+def configure(level=logging.INFO, fmt='text', sample=0.0):
+    """Write logs by a background thread, fmt is "text" or "json".
+
+    The payload of requests are logged at random by the rate `sample`.
+    """
+    global _listener, _sample_rate
+    if _listener:
+        _listener.stop()
+
+    _sample_rate = sample
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if fmt == 'json'
+                        else logging.Formatter(TEXT_FORMAT))
+    output.addFilter(DroppedFilter())
+
+    queue = Queue(QUEUE_SIZE)
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(AsyncHandler(queue))
+    root.setLevel(level)
+
+    _listener = QueueListener(queue, output)
+    _listener.start()
+
+
+def shutdown():
+    """Write all the queued records."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+
+MANIFEST_FILE = 'manifest.json'
+HASH_ALGORITHM = 'sha256'
+
+
+def hash_file(filename, algorithm=HASH_ALGORITHM, bufsize=1024 * 1024):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(bufsize)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def make_manifest(path, previous=None):
+    """Return manifest of all the files in the path.
+
+    The key of files is the relative path separated by "/", the value
+    is a dict with size, mtime and hash. If a file has same size and
+    mtime as in previous manifest, the old hash is reused.
+    """
+    oldfiles = previous.get('files', {}) if previous and \
+        previous.get('algorithm') == HASH_ALGORITHM else {}
+    files = {}
+    if os.path.isfile(path):
+        walker = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        path = os.path.dirname(path)
+    else:
+        walker = os.walk(path)
+    for root, dirs, names in walker:
+        for x in names:
+            filename = os.path.join(root, x)
+            name = os.path.relpath(filename, path).replace('\\', '/')
+            st = os.stat(filename)
+            old = oldfiles.get(name)
+            if old and old['size'] == st.st_size and \
+               old['mtime'] == st.st_mtime_ns:
+                digest = old['hash']
+            else:
+                digest = hash_file(filename)
+            files[name] = {
+                'size': st.st_size,
+                'mtime': st.st_mtime_ns,
+                'hash': digest,
+            }
+    return {
+        'algorithm': HASH_ALGORITHM,
+        'created': int(time.time()),
+        'count': len(files),
+        'size': sum([x['size'] for x in files.values()]),
+        'files': files,
+    }
+
+
+def diff_manifest(old, new):
+    """Return the added, changed and removed entries from old to new.
+
+    Both old and new could be a manifest or only files of a manifest,
+    only size and hash of each file are compared.
+    """
+    oldfiles = old.get('files', old) if old else {}
+    newfiles = new.get('files', new)
+    added, changed = [], []
+    for name in sorted(newfiles):
+        item = newfiles[name]
+        entry = {'name': name, 'size': item['size'], 'hash': item['hash']}
+        if name not in oldfiles:
+            added.append(entry)
+        elif (oldfiles[name].get('hash') != item['hash'] or
+              oldfiles[name].get('size') != item['size']):
+            changed.append(entry)
+    removed = sorted([x for x in oldfiles if x not in newfiles])
+    return {
+        'added': added,
+        'changed': changed,
+        'removed': removed,
+        'unchanged': len(newfiles) - len(added) - len(changed),
+    }
+
+
+def link_unchanged(path, manifest):
+    """Replace the files in path by hard links to the old output.
+
+    A file is replaced only if it's same as the one in old output, and
+    the old one isn't changed after manifest is made. So the unchanged
+    files keep their inodes and mtimes, return the number of them.
+    """
+    oldpath = manifest.get('output') if manifest and \
+        manifest.get('algorithm') == HASH_ALGORITHM else None
+    if not oldpath or not os.path.isdir(oldpath):
+        return 0
+    oldfiles = manifest['files']
+    n = 0
+    for root, dirs, names in os.walk(path):
+        for x in names:
+            filename = os.path.join(root, x)
+            name = os.path.relpath(filename, path).replace('\\', '/')
+            old = oldfiles.get(name)
+            if not old or old['size'] != os.path.getsize(filename):
+                continue
+            oldname = os.path.join(oldpath, *name.split('/'))
+            try:
+                st = os.stat(oldname)
+                if st.st_size != old['size'] or \
+                   st.st_mtime_ns != old['mtime'] or \
+                   hash_file(filename) != old['hash']:
+                    continue
+                tmpname = filename + '.link'
+                os.link(oldname, tmpname)
+                os.replace(tmpname, filename)
+            except OSError:
+                continue
+            n += 1
+    return n
+
+
+def read_manifest(path):
+    filename = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+
+def save_manifest(path, output):
+    """Make manifest of output and save it in project path."""
+    manifest = make_manifest(output, read_manifest(path))
+    manifest['output'] = output
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as fp:
+        json.dump(manifest, fp)
+    return manifest
@@ -0,0 +1,132 @@
+import fnmatch
+import os
+import re
+import sys
+
+
+def glob_escape(path):
+    """Return the pattern matches path only, it's used as exclude of
+    Pyarmor.
+
+    The glob chars, "," and "#" are quoted by "[]". The whitespace is
+    replaced by "?", because Pyarmor splits patterns by whitespace.
+
+    >>> glob_escape('my app/[a]*.py')
+    'my?app/[[]a][*].py'
+    """
+    return re.sub(r'\s', '?', re.sub(r'([*?[,#])', r'[\1]', path))
+
+
+class PathMatcher(object):
+    """Match relative path by all the patterns with one compiled regex.
+
+    It's same as "--exclude */pattern" of Pyarmor 8, the pattern is
+    matched by fnmatch with the path, so "*" matches "/" too, and the
+    case is ignored in Windows. The path is matched if the pattern
+    matches the end of it, or of any its parent directory, because
+    Pyarmor doesn't search the excluded directory.
+
+    >>> m = PathMatcher(['tests', 'setup.py', 'pkg/data', '*.pyc'])
+    >>> [m.match(x) for x in ('tests', 'a/tests/b.py', 'a/pkg/data/x.py')]
+    [True, True, True]
+    >>> [m.match(x) for x in ('mytests.py', 'a/pkg/data2', 'main.py')]
+    [False, False, False]
+    >>> PathMatcher(['a*.py']).match('a/b/c.py')
+    True
+    """
+
+    def __init__(self, patterns=()):
+        parts = []
+        for x in patterns:
+            x = x.replace('\\', '/').strip('/')
+            if x.startswith('./'):
+                x = x[2:]
+            if x:
+                parts.append(fnmatch.translate('*/' + x))
+        flags = re.I if sys.platform == 'win32' else 0
+        self._regex = re.compile('|'.join(parts), flags) if parts else None
+
+    def match(self, path):
+        if self._regex is None:
+            return False
+        path = '/' + path.replace('\\', '/').strip('/')
+        i = path.find('/', 1)
+        while i != -1:
+            if self._regex.match(path[:i]):
+                return True
+            i = path.find('/', i + 1)
+        return self._regex.match(path) is not None
+
+
+def find_excluded(src, excludes):
+    """Return the relative paths in src which match excludes, the ones
+    in the excluded directory are not listed.
+
+    >>> import tempfile
+    >>> src = tempfile.mkdtemp()
+    >>> for x in ('main.py', 'a/tests/b.py', 'tests/c.py'):
+    ...     os.makedirs(os.path.dirname(os.path.join(src, x)) or src,
+    ...                 exist_ok=True)
+    ...     open(os.path.join(src, x), 'w').close()
+    >>> find_excluded(src, ['tests'])
+    ['a/tests', 'tests']
+    """
+    matcher = PathMatcher(excludes)
+    if matcher._regex is None:
+        return []
+    result = set()
+    for root, dirs, files in os.walk(src):
+        prefix = os.path.relpath(root, src).replace('\\', '/')
+        prefix = '' if prefix == '.' else prefix + '/'
+        result.update([prefix + x for x in dirs + files
+                       if matcher.match(prefix + x)])
+        dirs[:] = [x for x in dirs if prefix + x not in result]
+    return sorted(result)
+
+
+def _walk(root, prefix, matcher, recursive):
+    for x in os.scandir(root):
+        if x.name.startswith('.'):
+            continue
+        name = prefix + x.name
+        if matcher.match(name):
+            continue
+        if x.is_dir():
+            if recursive:
+                for item in _walk(x.path, name + '/', matcher, True):
+                    yield item
+        elif x.name.endswith('.py'):
+            yield name, x.stat().st_size
+
+
+def find_sources(src, include, entries=(), excludes=()):
+    """Return the list of (relpath, size) of scripts to be obfuscated.
+
+    The include mode is one of "exact", "imports", "list" and "all".
+    """
+    if include == 'imports':
+        try:
+            from .imports import find_reachable
+        except Exception:
+            from imports import find_reachable
+        for x in entries:
+            if not os.path.exists(os.path.join(src, x)):
+                raise RuntimeError('No entry script "%s" found' % x)
+        return find_reachable(src, entries, excludes)
+
+    if include == 'exact':
+        result = []
+        for x in entries:
+            filename = os.path.join(src, x)
+            if not os.path.exists(filename):
+                raise RuntimeError('No entry script "%s" found' % x)
+            result.append((x.replace('\\', '/'), os.path.getsize(filename)))
+        return result
+
+    matcher = PathMatcher(excludes)
+    return sorted(_walk(src, '', matcher, include == 'all'))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,170 @@
+import base64
+import json
+
+from bisect import bisect_left, bisect_right, insort
+
+
+def sort_key(value):
+    """Return a key to sort the values of mixed types.
+
+    >>> sorted([3, 'b', None, 1, 'a'], key=sort_key)
+    [None, 1, 3, 'a', 'b']
+    """
+    if value is None or value == '':
+        return (0, 0)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    return (2, str(value))
+
+
+def encode_cursor(key, rid):
+    data = json.dumps([key, rid]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        key, rid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (key[0], key[1]), rid
+    except Exception:
+        raise RuntimeError('Invalid cursor "%s"' % cursor)
+
+
+class RecordIndex(object):
+    """In-memory secondary indexes of records, all records have "id".
+
+    Each field in `sorts` has a list of (key, id) kept sorted by bisect,
+    it's used to sort records, and to filter them by prefix or range.
+    Each field in `exacts` maps value to the set of ids. All of them
+    are updated when one record is added or removed.
+
+    >>> index = RecordIndex(['id', 'rcode'], ['mac'])
+    >>> index.reset([{'id': 1, 'rcode': 'r-b', 'mac': 'x'},
+    ...              {'id': 2, 'rcode': 'r-a'}, {'id': 3, 'rcode': 'q'}])
+    >>> [x['id'] for x in index.query(sort='rcode')['items']]
+    [3, 2, 1]
+    >>> index.add({'id': 4, 'rcode': 'r-c', 'mac': 'x'})
+    >>> r = index.query(prefix={'rcode': 'r-'}, exact={'mac': 'x'}, limit=1)
+    >>> r['total'], [x['id'] for x in r['items']]
+    (2, [1])
+    >>> [x['id'] for x in index.query(cursor=r['cursor'], prefix={
+    ...     'rcode': 'r-'}, exact={'mac': 'x'})['items']]
+    [4]
+    >>> index.remove(1)
+    >>> index.query(exact={'mac': 'x'}, sort='-id')['total']
+    1
+    """
+
+    def __init__(self, sorts=('id',), exacts=()):
+        self.records = {}
+        self._sorted = dict([(x, []) for x in sorts])
+        self._exact = dict([(x, {}) for x in exacts])
+
+    def reset(self, records):
+        self.records = dict([(x['id'], x) for x in records])
+        for field in self._sorted:
+            self._sorted[field] = sorted(
+                [(sort_key(x.get(field)), x['id']) for x in records])
+        for field in self._exact:
+            values = self._exact[field] = {}
+            for x in records:
+                values.setdefault(x.get(field), set()).add(x['id'])
+
+    def add(self, record):
+        rid = record['id']
+        if rid in self.records:
+            self.remove(rid)
+        self.records[rid] = record
+        for field, items in self._sorted.items():
+            insort(items, (sort_key(record.get(field)), rid))
+        for field, values in self._exact.items():
+            values.setdefault(record.get(field), set()).add(rid)
+
+    def remove(self, rid):
+        record = self.records.pop(rid, None)
+        if record is None:
+            return
+        for field, items in self._sorted.items():
+            item = sort_key(record.get(field)), rid
+            i = bisect_left(items, item)
+            if i < len(items) and items[i] == item:
+                del items[i]
+        for field, values in self._exact.items():
+            ids = values.get(record.get(field))
+            if ids:
+                ids.discard(rid)
+                if not ids:
+                    del values[record.get(field)]
+
+    def _range(self, field, start=None, end=None):
+        """Return ids of records start <= key <= end."""
+        items = self._sorted[field]
+        i = 0 if start is None else bisect_left(items, (start,))
+        j = len(items) if end is None else \
+            bisect_right(items, (end, float('inf')))
+        return set([x[1] for x in items[i:j]])
+
+    def query(self, prefix=None, ranges=None, exact=None, text=None,
+              sort='id', limit=100, cursor=None):
+        """Return the matched records in page, and cursor of next page.
+
+        The prefix and ranges filter sorted fields, the range is a pair
+        (min, max) both are inclusive and could be None. The text is a
+        dict {field: words}, the value of field must contain the words
+        ignoring case.
+        """
+        ids = None
+
+        def intersect(found):
+            return found if ids is None else ids & found
+
+        for field, value in (prefix or {}).items():
+            value = str(value)
+            ids = intersect(self._range(field, (2, value),
+                                        (2, value + '\uffff')))
+        for field, (start, end) in (ranges or {}).items():
+            ids = intersect(self._range(
+                field, None if start is None else sort_key(start),
+                None if end is None else sort_key(end)))
+        for field, value in (exact or {}).items():
+            ids = intersect(self._exact[field].get(value, set()))
+        for field, value in (text or {}).items():
+            value = str(value).lower()
+            ids = set([x for x in (self.records if ids is None else ids)
+                       if value in str(self.records[x].get(field) or '')
+                       .lower()])
+
+        reverse = sort.startswith('-')
+        field = sort.lstrip('-')
+        if field not in self._sorted:
+            raise RuntimeError('Unsupported sort field "%s"' % field)
+        items = self._sorted[field]
+        lo, hi = 0, len(items)
+        if cursor:
+            item = decode_cursor(cursor)
+            if reverse:
+                hi = bisect_left(items, item)
+            else:
+                lo = bisect_right(items, item)
+
+        result, last = [], None
+        for i in (range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)):
+            item = items[i]
+            if ids is None or item[1] in ids:
+                if limit and len(result) == limit:
+                    break
+                result.append(self.records[item[1]])
+                last = item
+        else:
+            last = None
+
+        return {
+            'total': len(self.records) if ids is None else len(ids),
+            'items': result,
+            'cursor': encode_cursor(*last) if last else None,
+        }
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
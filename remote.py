@@ -0,0 +1,318 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+from gzip import GzipFile
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+try:
+    from .manifest import hash_file
+    from .matcher import PathMatcher
+    from .scheduler import JobCancelled, current_job
+except Exception:
+    from manifest import hash_file
+    from matcher import PathMatcher
+    from scheduler import JobCancelled, current_job
+
+BUNDLE_PATH = 'bundles'
+
+# Query status of agents again after N seconds
+REFRESH_INTERVAL = 2
+
+# The agent is lost if it doesn't reply in N seconds
+REQUEST_TIMEOUT = 30
+
+# Each request waits for the build in agent at most N seconds
+WAIT_INTERVAL = 2
+
+# The header and environment variable of token shared by server and
+# agents
+TOKEN_HEADER = 'X-Agent-Token'
+TOKEN_ENV = 'PYARMOR_AGENT_TOKEN'
+
+# The metadata of version control systems isn't sent to agents
+VCS_DIRS = '.git', '.hg', '.svn'
+
+_pool = None
+
+
+class RemoteError(RuntimeError):
+    """The build is failed in agent, it's not retried."""
+
+
+def tree_digest(files):
+    """Return content address of a list of (relpath, hash)."""
+    h = hashlib.sha256()
+    for name, digest in sorted(files):
+        h.update(('%s %s\n' % (name, digest)).encode())
+    return h.hexdigest()
+
+
+def snapshot(path, excludes=(), cache=None, skips=()):
+    """Return the list of (relpath, hash) of all the files in path.
+
+    The paths match excludes, absolute paths in skips and VCS_DIRS are
+    ignored. If cache is a dict, the hash of file is reused when size
+    and mtime are same.
+    """
+    matcher = PathMatcher(excludes)
+    skips = [os.path.normpath(x) for x in skips]
+    cache = {} if cache is None else cache
+    result = []
+    for root, dirs, names in os.walk(path):
+        prefix = os.path.relpath(root, path).replace('\\', '/')
+        prefix = '' if prefix == '.' else prefix + '/'
+        dirs[:] = sorted([x for x in dirs if x not in VCS_DIRS and
+                          not matcher.match(prefix + x) and
+                          os.path.join(root, x) not in skips])
+        for x in names:
+            name = prefix + x
+            if matcher.match(name):
+                continue
+            filename = os.path.join(root, x)
+            st = os.stat(filename)
+            item = cache.get(filename)
+            if not item or item[:2] != (st.st_size, st.st_mtime_ns):
+                item = st.st_size, st.st_mtime_ns, hash_file(filename)
+                cache[filename] = item
+            result.append((name, item[2]))
+    return result
+
+
+def write_bundle(path, files, filename):
+    """Write the files in path as tar.gz archive.
+
+    The temporary file is unique for each thread, the same bundle may be
+    written by concurrent builds.
+    """
+    tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                threading.get_ident())
+    with open(tmpname, 'wb') as f:
+        with GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w|') as tar:
+                for name, digest in sorted(files):
+                    tar.add(os.path.join(path, *name.split('/')), name,
+                            recursive=False)
+    os.replace(tmpname, filename)
+
+
+def extract_tree(fileobj, path, strip=0):
+    """Extract tar.gz stream to path, the unsafe members are ignored.
+
+    The first `strip` components of each member name are removed. The
+    existing file is removed before writing, it may be a hard link.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        for m in tar:
+            parts = m.name.split('/')[strip:]
+            if not parts or '..' in parts or m.name.startswith('/') or \
+               not (m.isdir() or m.isfile()):
+                continue
+            target = os.path.join(path, *parts)
+            if m.isdir():
+                if not os.path.exists(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.remove(target)
+            with open(target, 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(m), f)
+            os.chmod(target, m.mode & 0o777)
+            os.utime(target, (m.mtime, m.mtime))
+
+
+class Agent(object):
+
+    def __init__(self, url, token=None):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.alive = True
+        self.slots = 1
+        self.load = 0
+        self.jobs = 0
+        self.checked = 0
+
+    def request(self, route, data=None, body=None, method=None,
+                headers=None, timeout=None):
+        """Return the response of route, raise OSError if agent is lost."""
+        headers = dict(headers or {})
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        req = Request(self.url + route, data=body, headers=headers,
+                      method=method)
+        try:
+            return urlopen(req, timeout=timeout or REQUEST_TIMEOUT)
+        except HTTPError as e:
+            if e.code == 401:
+                raise RemoteError('%s: invalid agent token' % self.url)
+            raise
+
+    def call(self, route, args=None, timeout=None):
+        with self.request('/agent/' + route, args or {},
+                          timeout=timeout) as res:
+            result = json.loads(res.read().decode())
+        if result['err']:
+            raise RemoteError('%s: %s' % (self.url, result['data']))
+        return result['data']
+
+    def refresh(self):
+        try:
+            status = self.call('status', timeout=REFRESH_INTERVAL)
+            self.slots = max(status['slots'], 1)
+            self.load = status['running'] + status['queued']
+            self.alive = True
+        except Exception as e:
+            if self.alive:
+                logging.warning('Agent %s is lost: %s', self.url, e)
+            self.alive = False
+        self.checked = time.time()
+
+    def score(self):
+        return float(max(self.load, self.jobs)) / self.slots
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'alive': self.alive,
+            'slots': self.slots,
+            'load': self.load,
+            'jobs': self.jobs,
+        }
+
+
+class AgentPool(object):
+    """Dispatch builds to remote agents.
+
+    The source path is sent as a tar.gz bundle named by the digest of
+    its contents, the agent caches it, so it's sent only once. The job
+    goes to the agent with lowest load per slot, if the agent is lost
+    (no reply in REQUEST_TIMEOUT) it's marked dead and the job is
+    requeued to the others.
+
+    The build in agent is polled, it's cancelled in the agent once the
+    job here is cancelled or timeout.
+    """
+
+    def __init__(self, urls, path, token=None):
+        self.agents = [Agent(x, token) for x in urls]
+        self.path = path
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _pick(self, excludes):
+        now = time.time()
+        for agent in self.agents:
+            if now - agent.checked > REFRESH_INTERVAL:
+                agent.refresh()
+        with self._lock:
+            agents = [x for x in self.agents
+                      if x.alive and x not in excludes]
+            if not agents:
+                return None
+            agent = min(agents, key=Agent.score)
+            agent.jobs += 1
+            return agent
+
+    def _bundle(self, src, excludes, skips):
+        with self._lock:
+            files = snapshot(src, excludes, self._hashes, skips)
+        digest = tree_digest(files)
+        filename = os.path.join(self.path, BUNDLE_PATH, digest + '.tar.gz')
+        if not os.path.exists(filename):
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            logging.info('Make source bundle %s', digest)
+            write_bundle(src, files, filename)
+        return digest, filename
+
+    def _upload(self, agent, digest, filename):
+        if agent.call('has', {'digest': digest}):
+            return
+        logging.info('Send bundle %s to %s', digest, agent.url)
+        size = str(os.path.getsize(filename))
+        with open(filename, 'rb') as f:
+            with agent.request('/agent/bundle?digest=' + digest, body=f,
+                               method='PUT',
+                               headers={'Content-Length': size}) as res:
+                result = json.loads(res.read().decode())
+        if result['err']:
+            raise RemoteError('%s: %s' % (agent.url, result['data']))
+
+    def _wait(self, agent, job):
+        """Wait for the build in agent, cancel it if current job is
+        cancelled."""
+        current = current_job()
+        while True:
+            if current is not None and current.cancelled:
+                try:
+                    agent.call('cancel', {'job': job})
+                except Exception as e:
+                    logging.warning('Failed to cancel build in agent %s: %s',
+                                    agent.url, e)
+                raise JobCancelled('Job %s is %s' % (current.id,
+                                                     current.reason))
+            state = agent.call('wait', {'job': job, 'timeout': WAIT_INTERVAL},
+                               timeout=REQUEST_TIMEOUT + WAIT_INTERVAL)
+            if state is None:
+                # The agent has been restarted
+                raise OSError('build %s is lost' % job)
+            if state['state'] in ('failed', 'cancelled'):
+                raise RemoteError('%s: %s' % (agent.url, state['error']))
+            if state['state'] == 'finished':
+                return
+
+    def build(self, src, output, args, excludes=(), skips=()):
+        """Build args in agents, extract the output to output path.
+
+        The excludes and skips are passed to snapshot, return the url
+        of agent.
+        """
+        digest, filename = self._bundle(src, excludes, skips)
+        failed = []
+        while True:
+            agent = self._pick(failed)
+            if agent is None:
+                raise RuntimeError('No build agent is available')
+            try:
+                logging.info('Build %s in agent %s', src, agent.url)
+                self._upload(agent, digest, filename)
+                job = agent.call('build', {'digest': digest, 'project': args})
+                self._wait(agent, job)
+                with agent.request('/agent/output?job=%s' % job) as res:
+                    extract_tree(res, output, strip=1)
+                agent.call('clean', {'job': job})
+                return agent.url
+            except RemoteError:
+                raise
+            except OSError as e:
+                logging.warning('Agent %s is lost: %s, requeue build',
+                                agent.url, e)
+                agent.alive = False
+                failed.append(agent)
+            finally:
+                with self._lock:
+                    agent.jobs -= 1
+
+    def status(self):
+        return [x.to_dict() for x in self.agents]
+
+
+def configure(urls, path, token=None):
+    """Dispatch builds to agents if there is any url."""
+    global _pool
+    _pool = AgentPool(urls, path, token) if urls else None
+
+
+def get_pool():
+    return _pool
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+try:
+    from .manifest import hash_file
+except Exception:
+    from manifest import hash_file
+
+CACHE_PATH = 'runtime-cache'
+
+# The runtime package depends on the registration files in home path
+REGISTER_FILES = 'license.lic', '.pyarmor_capsule.zip', 'config'
+
+
+def find_runtime_package(path):
+    """Return the path of runtime package in the path, None if no."""
+    for x in os.scandir(path):
+        if x.is_dir() and x.name.startswith('pyarmor_runtime_') and \
+           os.path.exists(os.path.join(x.path, '__init__.py')):
+            return x.path
+
+
+def link_tree(src, dst):
+    """Copy all the files in src to dst by hard links if possible."""
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    for x in os.scandir(src):
+        target = os.path.join(dst, x.name)
+        if x.is_dir():
+            link_tree(x.path, target)
+            continue
+        # Never write to an existing file, it may be linked to cache
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(x.path, target)
+        except OSError:
+            shutil.copy2(x.path, target)
+
+
+def _regular_files(path):
+    """Yield (name, filename) of the regular files in path, the name is
+    relative to the parent of path."""
+    if os.path.isfile(path):
+        yield os.path.basename(path), path
+    elif os.path.isdir(path):
+        parent = os.path.dirname(path)
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for x in sorted(names):
+                filename = os.path.join(root, x)
+                if os.path.isfile(filename):
+                    name = os.path.relpath(filename, parent)
+                    yield name.replace('\\', '/'), filename
+
+
+def make_key(options, files=()):
+    """Return cache key of runtime options and contents of files.
+
+    The files are registration files, so the runtime package is
+    generated again after registering new license. The regular files in
+    the directory (for example "config") are hashed too.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(path, 'config'))
+    >>> key = make_key({}, [os.path.join(path, 'config')])
+    >>> with open(os.path.join(path, 'config', 'global'), 'w') as f:
+    ...     n = f.write('[builder]')
+    >>> key == make_key({}, [os.path.join(path, 'config')])
+    False
+    """
+    h = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for x in files:
+        for name, filename in _regular_files(x):
+            h.update(('%s:%s' % (name, hash_file(filename))).encode())
+    return h.hexdigest()[:16]
+
+
+class RuntimeCache(object):
+    """Runtime packages generated once and reused by all builds.
+
+    Each entry is a folder named by key, it's generated in a temporary
+    folder first and renamed, so the builds never see partial entry.
+    """
+
+    _lock = threading.Lock()
+    _key_locks = {}
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, generate):
+        """Return the path of cached key, call generate(path) if no."""
+        path = os.path.join(self.path, key)
+        with self._lock:
+            lock = self._key_locks.setdefault(key, threading.Lock())
+        with lock:
+            if os.path.exists(path):
+                return path
+            logging.info('Generate runtime package %s', key)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp)
+            try:
+                generate(tmp)
+                os.rename(tmp, path)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not os.path.exists(path):
+                    raise
+        return path
@@ -0,0 +1,335 @@
+import heapq
+import itertools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from subprocess import call
+
+try:
+    from .events import publish
+except Exception:
+    from events import publish
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# Try the slots shared with other server processes again after N seconds
+SLOT_RETRY = 1
+
+_local = threading.local()
+_scheduler = None
+
+
+class JobCancelled(RuntimeError):
+    pass
+
+
+def kill_tree(pid):
+    """Kill process and all of its children.
+
+    In posix the process must be a session leader, it's started with
+    `start_new_session=True` or calls `os.setsid()`.
+    """
+    if sys.platform == 'win32':
+        call(['taskkill', '/F', '/T', '/PID', str(pid)])
+        return
+    try:
+        os.killpg(pid, signal.SIGTERM)
+        for i in range(20):
+            time.sleep(0.1)
+            os.killpg(pid, 0)
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def current_job():
+    """Return the job run in current thread, None if no."""
+    return getattr(_local, 'job', None)
+
+
+@contextmanager
+def phase(name):
+    """Record the time of one phase of current job."""
+    job = current_job()
+    t = time.time()
+    if job is not None:
+        publish('build.progress', id=job.id, key=job.key, phase=name)
+    try:
+        yield
+    finally:
+        if job is not None:
+            job.phases[name] = job.phases.get(name, 0) + time.time() - t
+
+
+class Job(object):
+
+    _counter = itertools.count(1)
+
+    def __init__(self, key, priority=PRIORITY_INTERACTIVE, timeout=0,
+                 name=None):
+        self.id = next(self._counter)
+        self.key = key
+        self.name = name
+        self.priority = priority
+        self.timeout = timeout
+        self.state = 'queued'
+        self.reason = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.phases = {}
+        self.info = {}
+        self.blocked = 0
+        self._slots = []
+        self._pids = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def add_pid(self, pid):
+        with self._lock:
+            if self.cancelled:
+                kill_tree(pid)
+            self._pids.add(pid)
+
+    def remove_pid(self, pid):
+        with self._lock:
+            self._pids.discard(pid)
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self.reason is not None or self.finished:
+                return False
+            logging.info('Cancel job %s (%s)', self.id, reason)
+            self.reason = reason
+            pids = list(self._pids)
+        for pid in pids:
+            kill_tree(pid)
+        return True
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'key': self.key,
+            'name': self.name,
+            'priority': self.priority,
+            'state': self.state,
+            'reason': self.reason,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class Scheduler(object):
+    """Run build jobs with priorities and concurrency limits.
+
+    At most `max_jobs` jobs run at the same time, and at most
+    `max_key_jobs` of them have same key (project). The job with lower
+    priority number starts first.
+
+    If there are many server processes, the limits are shared by slots
+    (see locks.Slots), and the jobs of all the processes are listed and
+    cancelled by hub.
+    """
+
+    def __init__(self, max_jobs=2, max_key_jobs=1, timeout=0, slots=None,
+                 hub=None):
+        self.max_jobs = max_jobs
+        self.max_key_jobs = max_key_jobs
+        self.timeout = timeout
+        self.slots = slots
+        self.hub = hub
+        self._queue = []
+        self._running = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        if hub is not None:
+            hub.handlers.update(jobs=lambda args: self._jobs(),
+                                cancel=lambda args: self._cancel(**args))
+
+    def _next_job(self):
+        if len(self._running) >= self.max_jobs:
+            return None
+        counts = {}
+        for job in self._running:
+            counts[job.key] = counts.get(job.key, 0) + 1
+        now = time.time()
+        for item in sorted(self._queue):
+            job = item[-1]
+            if not job.cancelled and job.blocked <= now and \
+               counts.get(job.key, 0) < self.max_key_jobs:
+                return job
+
+    def _take_slots(self, job):
+        """Take the shared slots of job, return False if the other
+        processes have taken all of them."""
+        if self.slots is None or job._slots:
+            return True
+        fd = self.slots.acquire('build', self.max_jobs)
+        if fd is None:
+            return False
+        job._slots.append(fd)
+        fd = self.slots.acquire('project-%s' % job.key, self.max_key_jobs)
+        if fd is None:
+            self._release_slots(job)
+            return False
+        job._slots.append(fd)
+        return True
+
+    def _release_slots(self, job):
+        for fd in job._slots:
+            self.slots.release(fd)
+        job._slots = []
+
+    def _wait_start(self, job):
+        with self._cond:
+            item = job.priority, next(self._seq), job
+            heapq.heappush(self._queue, item)
+            try:
+                while not job.cancelled:
+                    if self._next_job() is job:
+                        if self._take_slots(job):
+                            break
+                        # Let the next job start before trying again
+                        job.blocked = time.time() + SLOT_RETRY
+                        self._cond.notify_all()
+                    self._cond.wait(SLOT_RETRY if self.slots else None)
+            finally:
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+            if job.cancelled:
+                self._release_slots(job)
+                job.state = 'cancelled'
+                raise JobCancelled('Job %s is %s' % (job.id, job.reason))
+            job.state = 'running'
+            job.started = time.time()
+            self._running.append(job)
+
+    def _finish(self, job, state):
+        with self._cond:
+            job.state = state
+            job.finished = time.time()
+            self._running.remove(job)
+            self._release_slots(job)
+            self._cond.notify_all()
+
+    def run(self, key, func, priority=PRIORITY_INTERACTIVE, timeout=None,
+            name=None, on_done=None):
+        """Wait for a free slot then call func in current thread.
+
+        If on_done is set, it's called with the job at the end, no
+        matter the job is finished, failed or cancelled.
+        """
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            raise RuntimeError('Invalid priority "%s"' % priority)
+        try:
+            seconds = self.timeout if timeout is None else float(timeout)
+        except (TypeError, ValueError):
+            seconds = -1
+        if seconds < 0:
+            raise RuntimeError('Invalid timeout "%s"' % timeout)
+        job = Job(key, priority, seconds, name=name)
+        try:
+            self._wait_start(job)
+        except JobCancelled as e:
+            job.error = str(e)
+            job.finished = time.time()
+            self._done(job, on_done)
+            raise
+        publish('build.started', **job.to_dict())
+
+        timer = None
+        if job.timeout:
+            timer = threading.Timer(job.timeout, job.cancel, ('timeout',))
+            timer.daemon = True
+            timer.start()
+        _local.job = job
+        try:
+            result = func()
+        except Exception as e:
+            job.error = str(e)
+            self._finish(job, 'cancelled' if job.cancelled else 'failed')
+            if job.cancelled:
+                job.error = 'Job %s is %s' % (job.id, job.reason)
+                raise JobCancelled(job.error)
+            raise
+        else:
+            # The func may return normally even if it's cancelled
+            if job.cancelled:
+                job.error = 'Job %s is %s' % (job.id, job.reason)
+                self._finish(job, 'cancelled')
+                raise JobCancelled(job.error)
+            self._finish(job, 'finished')
+            return result
+        finally:
+            _local.job = None
+            if timer:
+                timer.cancel()
+            self._done(job, on_done)
+
+    def _done(self, job, on_done):
+        if on_done:
+            on_done(job)
+        publish('build.finished', error=job.error, phases=job.phases,
+                **job.to_dict())
+
+    def jobs(self):
+        """Return the running jobs, then the queued ones."""
+        if self.hub is None:
+            return self._jobs()
+        items = [x for result in self.hub.call('jobs') for x in result]
+        return sorted(items, key=lambda x: (
+            x['state'] != 'running', x['priority'], x['created']))
+
+    def _jobs(self):
+        with self._cond:
+            items = self._running + [x[-1] for x in sorted(self._queue)]
+            return [x.to_dict() for x in items]
+
+    def cancel(self, key=None, job_id=None):
+        """Cancel the jobs by key or id, return the cancelled jobs."""
+        if self.hub is None:
+            return self._cancel(key, job_id)
+        return [x for result in self.hub.call(
+            'cancel', dict(key=key, job_id=job_id)) for x in result]
+
+    def _cancel(self, key=None, job_id=None):
+        with self._cond:
+            items = self._running + [x[-1] for x in self._queue]
+        items = [x for x in items if x.id == job_id or (
+            job_id is None and x.key == key)]
+        result = [x for x in items if x.cancel()]
+        with self._cond:
+            self._cond.notify_all()
+        return [x.to_dict() for x in result]
+
+
+def configure(max_jobs=2, max_key_jobs=1, timeout=0, slots=None, hub=None,
+              first_id=1, id_step=1):
+    """Set the limits of builds.
+
+    The job ids of each server process start from first_id and are
+    increased by id_step, so they're unique in all the processes.
+    """
+    global _scheduler
+    Job._counter = itertools.count(first_id, id_step)
+    _scheduler = Scheduler(max_jobs, max_key_jobs, timeout, slots, hub)
+
+
+def get_scheduler():
+    if _scheduler is None:
+        configure()
+    return _scheduler
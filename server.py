@@ -1,16 +1,23 @@
 #! /usr/bin/env python
 import argparse
+import io
 import logging
 import json
 import os
 import posixpath
 import shutil
+import socket
+import stat
 import sys
+import time
+import uuid
+import zlib
 
 try:
-    from urllib import unquote
+    from urllib import quote, unquote
+    from urlparse import parse_qsl
 except Exception:
-    from urllib.parse import unquote
+    from urllib.parse import quote, unquote, parse_qsl
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler
 except ImportError:
@@ -20,16 +27,27 @@ try:
 except ImportError:
     import socketserver
 
-try:
-    from .handler import RootHandler
-    from .handler8 import RootHandler as RootHandler8
-except Exception:
-    from .handler import RootHandler
-    from .handler8 import RootHandler as RootHandler8
+from . import admission, bundle, events, hub, locks, logs, remote, \
+    scheduler, supervisor, trash, workers
+from .archive import (ARCHIVE_FORMATS, CHUNK_SIZE, ChunkedWriter,
+                      CompressWriter, accept_encoding, copy_range,
+                      parse_range, write_archive)
 
 
 __version__ = '2.6'
 
+# Compress JSON response if it's larger than this size
+COMPRESS_MIN_SIZE = 1024
+
+# Reject the request if its body (decompressed) is larger than this size
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Send a comment to event stream if there is no event in N seconds
+EVENT_HEARTBEAT = 15
+
+# The lock files shared by server processes are in this path of homepath
+RUN_PATH = 'run'
+
 __config__ = {
     'version': __version__,
     'wwwroot': os.path.join(os.path.dirname(__file__), 'static'),
@@ -51,58 +69,372 @@ def _fix_up_win_console_freeze():
         pass
 
 
+class HelperServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Handle each request in a new thread, so that a running build
+    doesn't block the other requests."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class HelperUnixServer(HelperServer):
+    """Serve on Unix domain socket, the socket file is removed when
+    the server which binds it is closed."""
+
+    address_family = getattr(socket, 'AF_UNIX', None)
+    bound = False
+
+    def server_bind(self):
+        HelperServer.server_bind(self)
+        self.bound = True
+
+    def server_close(self):
+        HelperServer.server_close(self)
+        if self.bound and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
 class HelperHandler(BaseHTTPRequestHandler):
 
     server_version = "HelperHTTP/" + __version__
-    root_handler = RootHandler8(__config__)
+    root_handler = None
+    status = None
+
+    # Use the headers X-Forwarded-* set by reverse proxy
+    trust_proxy = False
+    # "X-Accel-Redirect" or "X-Sendfile", let the proxy send files
+    sendfile = None
+    sendfile_prefix = '/_files'
+    # The allowed origins of cross-origin requests, "*" is any one
+    cors_origins = ('*',)
+    # Serve static files from this bundle instead of wwwroot
+    bundle = None
+
+    def handle_one_request(self):
+        """Handle one request, then write one access log."""
+        self.status = self.payload = None
+        self.failed = False
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if self.status is not None:
+            self.log_access()
+        logs.set_request(None)
+
+    def parse_request(self):
+        self.start_time = time.time()
+        result = BaseHTTPRequestHandler.parse_request(self)
+        rid = self.headers.get('X-Request-Id') if result else None
+        self.request_id = rid[:64] if rid else uuid.uuid4().hex[:16]
+        logs.set_request(self.request_id)
+        return result
+
+    def send_response(self, code, message=None):
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        if getattr(self, 'request_id', None):
+            self.send_header("X-Request-Id", self.request_id)
+
+    def log_request(self, code='-', size='-'):
+        self.status = int(code)
+
+    def forwarded(self, name):
+        """Return header X-Forwarded-<name> if the proxy is trusted."""
+        headers = getattr(self, 'headers', None)
+        if self.trust_proxy and headers is not None:
+            return headers.get('X-Forwarded-' + name)
+
+    def address_string(self):
+        """Return the client address, it's the last one of header
+        X-Forwarded-For if the proxy is trusted, the others may be set by
+        the client."""
+        value = self.forwarded('For')
+        if value:
+            return value.split(',')[-1].strip()
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def external_url(self, path):
+        """Return the url of path seen by the client of proxy."""
+        path = (self.forwarded('Prefix') or '').rstrip('/') + path
+        host = self.forwarded('Host')
+        if host:
+            return '%s://%s%s' % (self.forwarded('Proto') or 'http',
+                                  host.split(',')[0].strip(), path)
+        return path
+
+    def send_cors_headers(self, expose=None):
+        """Send CORS headers if the origin of request is allowed."""
+        if '*' in self.cors_origins:
+            origin = '*'
+        else:
+            origin = self.headers.get('Origin')
+            if origin not in self.cors_origins:
+                return
+            self.send_header("Vary", "Origin")
+        self.send_header("Access-Control-Allow-Origin", origin)
+        self.send_header("Access-Control-Allow-Methods",
+                         "GET,POST,OPTIONS,PUT")
+        self.send_header("Access-Control-Allow-Headers",
+                         "Content-Type,Content-Encoding,If-None-Match")
+        if expose:
+            self.send_header("Access-Control-Expose-Headers", expose)
+
+    def send_offload(self, path, ctype, headers=None):
+        """Send header X-Accel-Redirect or X-Sendfile without body, the
+        proxy sends the file."""
+        path = os.path.abspath(path)
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if self.sendfile == 'X-Sendfile':
+            self.send_header("X-Sendfile", path)
+        else:
+            path = path.replace('\\', '/')
+            self.send_header("X-Accel-Redirect", quote(
+                self.sendfile_prefix.rstrip('/') + '/' + path.lstrip('/')))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.warning("%s - %s", self.address_string(), format % args)
+
+    def log_access(self):
+        """Log request id, route, status and duration of request.
+
+        The payload is logged only if the request is failed or sampled.
+        """
+        duration = time.time() - self.start_time
+        route = self.path.split('?', 1)[0]
+        extra = dict(request=self.request_id, method=self.command,
+                     route=route, status=self.status,
+                     duration=round(duration, 6))
+        fmt = "%s %s %s %s %.1fms"
+        args = [self.address_string(), self.command, route, self.status,
+                duration * 1000]
+        if self.payload is not None and (
+                self.failed or self.status >= 400 or logs.sampled()):
+            extra['payload'] = logs.truncate(self.payload)
+            fmt += " %s"
+            args.append(extra['payload'])
+        logging.info(fmt, *args, extra=extra)
 
     def do_OPTIONS(self):
         """Serve a OPTIONS request."""
         self.send_response(204)
-        self.send_header("Access-Control-Allow-Methods", "GET,POST,OPTIONS,PUT")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_cors_headers()
         self.end_headers()
 
+    def read_json(self):
+        """Return the JSON body of request, the body may be compressed
+        by gzip. Send error and return None if it's invalid."""
+        try:
+            n = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return None
+        if n > MAX_BODY_SIZE:
+            self.send_error(413, "Request body is too large")
+            return None
+        if n <= 0:
+            return {}
+        data = self.rfile.read(n)
+        encoding = self.headers.get('Content-Encoding', 'identity')
+        if encoding == 'gzip':
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = d.decompress(data, MAX_BODY_SIZE)
+                if d.unconsumed_tail:
+                    self.send_error(413, "Request body is too large")
+                    return None
+                if not d.eof:
+                    raise EOFError('Compressed body is truncated')
+            except (zlib.error, OSError, EOFError) as e:
+                self.send_error(400, "Invalid gzip body: %s" % e)
+                return None
+        elif encoding != 'identity':
+            self.send_error(415, "Unsupported Content-Encoding")
+            return None
+        try:
+            args = json.loads(data.decode())
+            return {} if args is None else args
+        except ValueError as e:
+            self.send_error(400, "Invalid JSON body: %s" % e)
+            return None
+
     def do_POST(self):
         """Serve a POST request."""
-        t = self.headers.get('Content-Type')
-        self.log_message("Content-Type: %s", t)
-
-        n = int(self.headers.get('Content-Length', 0))
-        if n == 0:
-            args = {}
-        else:
-            args = json.loads(self.rfile.read(n).decode())
-        self.log_message("Post-Data: %s", args)
+        args = self.read_json()
+        if args is None:
+            return
+        self.payload = args
+
+        # The tag could be sent in argument "_etag" too, if it's matched
+        # reply {"err": 0, "unchanged": true} instead of 304
+        path = self.path[1:]
+        known = args.pop('_etag', None) if isinstance(args, dict) else None
+        tag = self.headers.get('If-None-Match')
+        etag = self.get_etag(path, args)
+        if etag and tag == etag:
+            self.send_response(304)
+            self.send_header("ETag", tag)
+            self.send_cors_headers(expose="ETag")
+            self.end_headers()
+            return
+        if etag and known == etag:
+            self.send_json(dict(err=0, unchanged=True), etag)
+            return
+
+        limit = admission.get_limit(path)
+        if limit:
+            try:
+                slot = limit.acquire()
+            except admission.Rejected as e:
+                headers = {'Retry-After': str(e.retry_after)}
+                self.send_json(dict(err=1, data=str(e), reason=e.reason,
+                                    retry=e.retry_after),
+                               status=429, headers=headers)
+                return
 
         result = dict(err=0)
         try:
-            result['data'] = self.root_handler.dispatch(self.path[1:], args)
+            result['data'] = self.root_handler.dispatch(path, args)
         except Exception as e:
             logging.exception("Failed to handle request")
+            self.failed = True
             result['err'] = 1
             result['data'] = str(e)
+        finally:
+            if limit:
+                limit.release(time.time() - self.start_time, slot)
 
         if result:
-            data = json.dumps(result).encode()
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
+            self.send_json(result, None if result['err'] else etag)
+
+    def send_json(self, result, etag=None, status=200, headers=None):
+        """Send result as JSON, compress it if it's large.
+
+        The JSON is encoded piece by piece, the large one is compressed
+        and sent by chunks, so it's never held in memory.
+        """
+        chunks = json.JSONEncoder().iterencode(result)
+        head, size = [], 0
+        for x in chunks:
+            head.append(x)
+            size += len(x)
+            if size >= COMPRESS_MIN_SIZE:
+                break
+        encoding = accept_encoding(self.headers.get('Accept-Encoding')) \
+            if size >= COMPRESS_MIN_SIZE else None
+        chunked = encoding and self.request_version >= 'HTTP/1.1'
+
+        # The status line must be HTTP/1.1 for chunked response
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Connection", "close")
+        else:
+            data = ''.join(head + list(chunks)).encode()
             self.send_header("Content-Length", str(len(data)))
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Access-Control-Allow-Methods", "GET,POST,OPTIONS,PUT")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type")
-            self.send_header("Last-Modified", self.date_time_string())
-            self.end_headers()
+        self.send_header("Vary", "Accept-Encoding")
+        expose = [x for x in ('ETag', 'Retry-After')
+                  if (x == 'ETag' and etag) or x in (headers or {})]
+        self.send_cors_headers(expose=','.join(expose))
+        self.send_header("Last-Modified", self.date_time_string())
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        if not encoding:
             self.wfile.write(data)
+            return
+
+        output = ChunkedWriter(self.wfile) if chunked else self.wfile
+        writer = CompressWriter(output, encoding)
+        for x in chunks:
+            head.append(x)
+            size += len(x)
+            if size >= CHUNK_SIZE:
+                writer.write(''.join(head).encode())
+                head, size = [], 0
+        writer.write(''.join(head).encode())
+        writer.close()
+        if chunked:
+            output.close()
+
+    def get_etag(self, path, args):
+        try:
+            return self.root_handler.get_etag(path, args)
+        except Exception:
+            logging.exception("Failed to get etag of %s", path)
 
     def do_GET(self):
         """Serve a GET request."""
+        if self.path.startswith('/project/download'):
+            return self.send_download()
+        if self.path.split('?', 1)[0] == '/events':
+            return self.send_events()
+        if self.path == '/metrics':
+            return self.send_metrics()
         f = self.send_head()
         if f:
             self.copyfile(f, self.wfile)
             f.close()
 
+    def send_metrics(self):
+        """Send the counters of admission control as Prometheus text."""
+        data = ('\n'.join(admission.metrics()) + '\n').encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_events(self):
+        """Push events to client as Server-Sent Events.
+
+        Query "types" is comma separated prefixes of event types, the
+        client reconnected with header "Last-Event-ID" gets the missed
+        events first.
+        """
+        query = dict(parse_qsl(self.path.split('?', 1)[-1])) \
+            if '?' in self.path else {}
+        types = [x for x in query.get('types', '').split(',') if x]
+        try:
+            last_id = int(self.headers.get('Last-Event-ID'))
+        except (TypeError, ValueError):
+            last_id = None
+
+        bus = events.get_bus()
+        subscriber = bus.subscribe(types, last_id)
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_cors_headers()
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+            while True:
+                lines = []
+                for x in subscriber.get(EVENT_HEARTBEAT):
+                    if x['id'] is not None:
+                        lines.append('id: %d\n' % x['id'])
+                    lines.append('event: %s\ndata: %s\n\n' % (
+                        x['type'], json.dumps(dict(x['data'],
+                                                   time=x['time']))))
+                self.wfile.write((''.join(lines) or ': ping\n\n').encode())
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            bus.unsubscribe(subscriber)
+
     def do_HEAD(self):
         """Serve a HEAD request."""
         f = self.send_head()
@@ -120,13 +452,16 @@ class HelperHandler(BaseHTTPRequestHandler):
         None, in which case the caller has nothing further to do.
 
         """
+        if self.bundle:
+            return self.send_bundle_head()
         path = self.translate_path(self.path[1:])
         f = None
         if os.path.isdir(path):
             if not self.path.endswith('/'):
                 # redirect browser - doing basically what apache does
                 self.send_response(301)
-                self.send_header("Location", self.path + "/")
+                self.send_header("Location", self.external_url(
+                    self.path + "/"))
                 self.end_headers()
                 return None
             for index in "index.html", "index.htm":
@@ -139,6 +474,12 @@ class HelperHandler(BaseHTTPRequestHandler):
                 return None
 
         ctype = self.guess_type(path)
+        if self.sendfile:
+            if not os.path.isfile(path):
+                self.send_error(404, "File not found")
+            else:
+                self.send_offload(path, ctype)
+            return None
         try:
             # Always read in binary mode. Opening files in text mode may cause
             # newline translations, making the actual size of the content
@@ -155,6 +496,142 @@ class HelperHandler(BaseHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def send_bundle_head(self):
+        """Same as send_head, but the file is looked up in the bundle."""
+        path = self.path[1:].split('?', 1)[0].split('#', 1)[0]
+        key = self.bundle.normpath(unquote(path))
+        if self.bundle.is_dir(key):
+            if not path.endswith('/') and key:
+                self.send_response(301)
+                self.send_header("Location", self.external_url(
+                    self.path + "/"))
+                self.end_headers()
+                return None
+            key = posixpath.join(key, 'index.html')
+        entry = self.bundle.lookup(key)
+        if entry is None:
+            self.send_error(404, "File not found")
+            return None
+
+        if self.headers.get('If-None-Match') == entry['etag']:
+            self.send_response(304)
+            self.send_header("ETag", entry['etag'])
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header("Content-type", entry['ctype'])
+        self.send_header("Content-Length", str(entry['size']))
+        self.send_header("ETag", entry['etag'])
+        self.send_header("Last-Modified",
+                         self.date_time_string(entry['mtime']))
+        self.end_headers()
+        return io.BytesIO(self.bundle.read(entry))
+
+    def send_download(self):
+        """Send build output of one project.
+
+        The query arguments are project `id`, optional `path` relative
+        to output path, and optional archive `format`. The directory is
+        always sent as archive, the single file is sent as it is unless
+        `format` is set.
+
+        """
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        args = dict(parse_qsl(query))
+        try:
+            args['id'] = int(args.get('id', ''))
+            info = self.root_handler.dispatch('project/output', args)
+        except Exception as e:
+            self.send_error(404, str(e))
+            return
+
+        relpath = args.get('path', '').strip('/')
+        if relpath:
+            root = os.path.normpath(info['path'])
+            path = os.path.normpath(os.path.join(root, relpath))
+            if not path.startswith(root + os.sep):
+                self.send_error(403, "Path out of output")
+                return
+        else:
+            path = info['bundle'] if info['bundle'] and \
+                os.path.exists(info['bundle']) else info['path']
+        if not os.path.exists(path):
+            self.send_error(404, "No build output found")
+            return
+
+        fmt = args.get('format')
+        if fmt and fmt not in ARCHIVE_FORMATS:
+            self.send_error(400, "Unsupported format")
+        elif os.path.isdir(path) or fmt:
+            self.send_archive(path, fmt or 'zip')
+        else:
+            self.send_file(path)
+
+    def send_archive(self, path, fmt):
+        """Generate archive on the fly and send it by chunks."""
+        suffix, ctype = ARCHIVE_FORMATS[fmt]
+        filename = os.path.basename(os.path.normpath(path)) + suffix
+        chunked = self.request_version >= 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Disposition",
+                         'attachment; filename="%s"' % filename)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        output = ChunkedWriter(self.wfile) if chunked else self.wfile
+        try:
+            write_archive(path, output, fmt)
+            if chunked:
+                output.close()
+        except Exception:
+            # Headers have been sent, the only way is to drop connection
+            logging.exception("Failed to send archive of %s", path)
+
+    def send_file(self, path):
+        """Send one file, support header "Range" to resume download."""
+        if self.sendfile:
+            self.send_offload(path, self.extensions_map[''], {
+                "Content-Disposition": 'attachment; filename="%s"'
+                % os.path.basename(path)})
+            return
+        fs = os.stat(path)
+        etag = '"%x-%x"' % (int(fs.st_mtime), fs.st_size)
+        rng = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range not in (
+                etag, self.date_time_string(fs.st_mtime)):
+            rng = None
+        try:
+            rng = parse_range(rng, fs.st_size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % fs.st_size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = rng if rng else (0, fs.st_size - 1)
+        with open(path, 'rb') as f:
+            self.send_response(206 if rng else 200)
+            self.send_header("Content-type", self.extensions_map[''])
+            self.send_header("Content-Disposition", 'attachment; '
+                             'filename="%s"' % os.path.basename(path))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified",
+                             self.date_time_string(fs.st_mtime))
+            if rng:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, end, fs.st_size))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            copy_range(f, self.wfile, start, end - start + 1)
+
     def translate_path(self, path):
         """Translate a /-separated PATH to the local filename syntax.
 
@@ -217,11 +694,135 @@ class HelperHandler(BaseHTTPRequestHandler):
         }
 
 
+def remove_stale_socket(path):
+    """Remove the socket file left by the last server, raise error if
+    it's used by any server."""
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise RuntimeError('%s is not a socket file' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        raise RuntimeError('Unix socket %s is in use' % path)
+    finally:
+        sock.close()
+
+
+def make_server(args):
+    """Bind the address, or serve on the socket inherited from the
+    supervisor."""
+    if args.worker_fd is None:
+        if not args.unix_socket:
+            return HelperServer((args.host, args.port), HelperHandler)
+        remove_stale_socket(args.unix_socket)
+        server = HelperUnixServer(args.unix_socket, HelperHandler)
+        if args.socket_mode is not None:
+            os.chmod(args.unix_socket, args.socket_mode)
+        return server
+    sock = socket.socket(fileno=args.worker_fd)
+    cls = HelperUnixServer if sock.family == HelperUnixServer.address_family \
+        else HelperServer
+    server = cls(sock.getsockname(), HelperHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    return server
+
+
+def server_location(server):
+    if isinstance(server, HelperUnixServer):
+        return 'unix socket %s' % server.server_address
+    return '%s port %s' % server.server_address[:2]
+
+
+def open_browser(args):
+    if args.no_browser or args.unix_socket:
+        return
+    from webbrowser import open_new_tab
+    open_new_tab("http://%s:%d/%s" % (args.host, args.port, args.index))
+
+
+def run_supervisor(args, argv):
+    """Bind the address, then serve it by worker processes."""
+    trash.configure(os.path.join(__config__['homepath'], trash.TRASH_PATH))
+    server = make_server(args)
+    logging.info("Serving HTTP on %s by %d processes ...",
+                 server_location(server), args.processes)
+    command, env = supervisor.worker_command(
+        __package__ + '.server', __file__, argv)
+
+    open_browser(args)
+    try:
+        supervisor.Supervisor(command, env, server.fileno(),
+                              args.processes).run()
+    finally:
+        server.server_close()
+
+
+def load_root_handler(v7=False):
+    """Import only the handlers of selected Pyarmor generation."""
+    if v7:
+        from .handler import RootHandler
+    else:
+        from .handler8 import RootHandler
+    return RootHandler(__config__)
+
+
+def measure_startup(args):
+    """Print the time and modules cost by each startup step as json.
+
+    The modules of pyarmor are loaded by the first route which needs
+    them, step "version" shows this cost.
+    """
+    try:
+        from resource import getrusage, RUSAGE_SELF
+    except ImportError:
+        getrusage = None
+
+    result = []
+    t0 = time.time()
+
+    def record(step, func):
+        n = len(sys.modules)
+        t = time.time()
+        value = func()
+        result.append({
+            'step': step,
+            'time': round(time.time() - t, 6),
+            'modules': len(sys.modules) - n,
+            'maxrss': getrusage(RUSAGE_SELF).ru_maxrss if getrusage else 0,
+        })
+        return value
+
+    handler = record('import', lambda: load_root_handler(args.enable_v7))
+    server = record('bind', lambda: HelperServer(
+        (args.host, args.port), HelperHandler))
+    server.server_close()
+    record('version', lambda: handler.dispatch('version', {}))
+
+    print(json.dumps({
+        'python': '%s.%s.%s' % sys.version_info[:3],
+        'v7': bool(args.enable_v7),
+        'total': round(time.time() - t0, 6),
+        'pyarmor': sorted(x for x in sys.modules if x.startswith('pyarmor.')
+                          and not x.startswith(__package__ or 'pyarmor.web')),
+        'steps': result,
+    }, indent=2))
+
+
 def main(argv=None):
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(levelname)-8s %(message)s',
-    )
+    logs.configure()
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['build']:
+        from .batch import main as build_main
+        return build_main(argv[1:])
+    if argv[:1] == ['agent']:
+        from .agent import main as agent_main
+        return agent_main(argv[1:])
+
     parser = argparse.ArgumentParser(
         prog='pyarmor-webui',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -234,32 +835,175 @@ def main(argv=None):
                         help='Bind host, default is localhost')
     parser.add_argument('-n', '--no-browser', action='store_true',
                         help='Do not open web browser')
+    parser.add_argument('--unix-socket', metavar='PATH',
+                        help='Serve on Unix domain socket instead of host '
+                        'and port, no web browser is opened')
+    parser.add_argument('--socket-mode', type=lambda x: int(x, 8),
+                        metavar='MODE', help='Change mode of Unix socket '
+                        'file, for example, 660')
+    parser.add_argument('--trust-proxy', action='store_true',
+                        help='Use headers X-Forwarded-* set by reverse '
+                        'proxy')
+    parser.add_argument('--sendfile', choices=('x-accel-redirect',
+                                               'x-sendfile'),
+                        help='Let reverse proxy send static files and '
+                        'downloads by this header')
+    parser.add_argument('--sendfile-prefix', default='/_files',
+                        help='The internal location of X-Accel-Redirect, '
+                        'default is /_files')
+    parser.add_argument('--static-bundle', action='store_true',
+                        help='Pack static files to one bundle in data '
+                        'path, serve them from the bundle')
+    parser.add_argument('--cors-origin', action='append', metavar='ORIGIN',
+                        help='Allow cross-origin requests from ORIGIN, it '
+                        'could be repeated, default is any origin')
+    parser.add_argument('--no-cors', action='store_true',
+                        help='Do not allow cross-origin requests')
     parser.add_argument('-7', '--enable-v7', action='store_true',
                         help='Force to use Pyarmor 7 commands')
     parser.add_argument('-i', '--index', default='',
                         help='Index page, default is index.html')
     parser.add_argument('--data-path',
                         help='Where to save projects, default is ~/.pyarmor')
-    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='Run pyarmor in N warm worker processes, '
+                        'default is 0, start new process for each build')
+    parser.add_argument('--pool-jobs', type=int, default=50,
+                        help='Recycle worker after N jobs, default is 50')
+    parser.add_argument('--pool-memory', type=int, default=0,
+                        help='Recycle worker if its max rss exceeds N MB')
+    parser.add_argument('--max-builds', type=int, default=2,
+                        help='Max builds run at the same time, default is 2')
+    parser.add_argument('--max-project-builds', type=int, default=1,
+                        help='Max builds of one project run at the same '
+                        'time, default is 1')
+    parser.add_argument('--build-timeout', type=int, default=0,
+                        help='Cancel build if it runs more than N seconds')
+    parser.add_argument('--limit', action='append', metavar='ROUTE=N[/RATE]',
+                        type=admission.parse_limit, default=[],
+                        help='Allow at most N concurrent requests and RATE '
+                        'requests per second of route, 0 is no limit, it '
+                        'could be repeated')
+    parser.add_argument('--default-limits', action='store_true',
+                        help='Limit the expensive routes by default values, '
+                        'which could be changed by "--limit"')
+    parser.add_argument('--agent', action='append', metavar='URL',
+                        help='Dispatch builds to agent started by '
+                        '"pyarmor-webui agent", it could be repeated')
+    parser.add_argument('--agent-token', default=os.getenv(remote.TOKEN_ENV),
+                        help='The token shared with agents, default is '
+                        'environment variable %s' % remote.TOKEN_ENV)
+    parser.add_argument('--log-format', choices=('text', 'json'),
+                        default='text', help='Write logs as text or JSON '
+                        'lines, default is text')
+    parser.add_argument('--log-sample', type=float, default=0.0,
+                        metavar='RATE', help='Log payload of requests at '
+                        'this rate (0-1), default is 0, only failed ones')
+    parser.add_argument('--processes', type=int, default=0, metavar='N',
+                        help='Serve requests by N worker processes sharing '
+                        'the listening socket, default is 0, serve in '
+                        'this process')
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--hub-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-index', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--measure-startup', action='store_true',
+                        help='Print time and imported modules of startup '
+                        'steps then exit')
+    args = parser.parse_args(argv)
+
+    if args.log_format != 'text' or args.log_sample:
+        logs.configure(fmt=args.log_format, sample=args.log_sample)
 
     if args.data_path:
         __config__['homepath'] = os.path.abspath(args.data_path)
     logging.info("Data path: %s", __config__['homepath'])
 
+    if args.measure_startup:
+        return measure_startup(args)
+
+    if args.unix_socket and sys.platform == 'win32':
+        parser.error('option --unix-socket is not supported in Windows')
+    HelperHandler.trust_proxy = args.trust_proxy
+    HelperHandler.sendfile = {'x-accel-redirect': 'X-Accel-Redirect',
+                              'x-sendfile': 'X-Sendfile'}.get(args.sendfile)
+    HelperHandler.sendfile_prefix = args.sendfile_prefix
+    HelperHandler.cors_origins = () if args.no_cors \
+        else tuple(args.cors_origin or ['*'])
+    if args.static_bundle:
+        if args.sendfile:
+            parser.error('option --static-bundle conflicts with --sendfile')
+        HelperHandler.bundle = bundle.open_bundle(
+            __config__['wwwroot'],
+            os.path.join(__config__['homepath'], bundle.BUNDLE_FILE),
+            HelperHandler.extensions_map)
+
+    worker = args.worker_fd is not None
+    if args.processes and not worker:
+        if sys.platform == 'win32':
+            parser.error('option --processes is not supported in Windows')
+        return run_supervisor(args, argv)
+
+    trash.configure(os.path.join(__config__['homepath'], trash.TRASH_PATH),
+                    clean=not worker)
+
+    slots = client = None
+    if worker:
+        # Share the limits, events and jobs with the other workers
+        slots = locks.Slots(os.path.join(__config__['homepath'], RUN_PATH))
+        bus = events.get_bus()
+        client = hub.HubClient(socket.socket(fileno=args.hub_fd),
+                               on_event=bus.dispatch)
+        bus.relay = client.publish
+        __config__['home_check_interval'] = 0
+
     if args.enable_v7:
         logging.info("Force to use Pyarmor 7 commands")
-        HelperHandler.root_handler = RootHandler(__config__)
+    HelperHandler.root_handler = load_root_handler(args.enable_v7)
+
+    scheduler.configure(args.max_builds, args.max_project_builds,
+                        args.build_timeout, slots=slots, hub=client,
+                        first_id=args.worker_index + 1,
+                        id_step=max(args.processes, 1))
+    admission.configure(args.limit, slots=slots,
+                        defaults=args.default_limits)
+    if client:
+        client.start()
+
+    if args.agent:
+        if args.enable_v7:
+            parser.error('build agents only work with Pyarmor 8')
+        if not args.agent_token:
+            parser.error('the token shared with agents is required, set '
+                         'option --agent-token or environment variable %s'
+                         % remote.TOKEN_ENV)
+        logging.info("Dispatch builds to agents: %s", ', '.join(args.agent))
+        remote.configure(args.agent,
+                         os.path.join(__config__['homepath'], 'remote'),
+                         args.agent_token)
+
+    if args.pool_size:
+        logging.info("Start %d pyarmor workers", args.pool_size)
+        workers.configure(args.pool_size, args.pool_jobs, args.pool_memory,
+                          prestart='pyarmor.pyarmor' if args.enable_v7
+                          else 'pyarmor.cli.__main__')
 
     if sys.platform == 'win32':
         _fix_up_win_console_freeze()
 
-    server = socketserver.TCPServer((args.host, args.port), HelperHandler)
-    logging.info("Serving HTTP on %s port %s ...", *server.server_address)
+    server = make_server(args)
+    if worker:
+        supervisor.watch_parent(server.shutdown)
+        logging.info("Worker %d serving HTTP on %s ...", os.getpid(),
+                     server_location(server))
+        return server.serve_forever()
+    logging.info("Serving HTTP on %s ...", server_location(server))
 
-    if not args.no_browser:
-        from webbrowser import open_new_tab
-        open_new_tab("http://%s:%d/%s" % (args.host, args.port, args.index))
-    server.serve_forever()
+    open_browser(args)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from subprocess import Popen, TimeoutExpired
+
+try:
+    from .hub import Hub
+except Exception:
+    from hub import Hub
+
+# A worker exits in N seconds after started is thought as crashed, it's
+# restarted after a delay which is doubled each time, at most MAX_DELAY
+MIN_UPTIME = 10
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+
+# Wait N seconds for workers to exit before killing them
+STOP_TIMEOUT = 10
+
+
+def worker_command(module, filename, argv):
+    """Return the command line and environment to start a worker.
+
+    The path of top package is prepended to PYTHONPATH of the worker,
+    so it could import the same module.
+    """
+    root = os.path.dirname(os.path.abspath(filename))
+    for _ in module.split('.')[:-1]:
+        root = os.path.dirname(root)
+    code = 'import sys; from %s import main; main(sys.argv[1:])' % module
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [x for x in [env.get('PYTHONPATH')] if x])
+    return [sys.executable, '-c', code] + list(argv), env
+
+
+def watch_parent(callback, interval=1):
+    """Call callback in a daemon thread once the parent process exits."""
+    ppid = os.getppid()
+
+    def watch():
+        while os.getppid() == ppid:
+            time.sleep(interval)
+        logging.warning('Supervisor %d exited, stop this worker', ppid)
+        callback()
+
+    thread = threading.Thread(target=watch, name='watch-parent')
+    thread.daemon = True
+    thread.start()
+
+
+class Supervisor(object):
+    """Start worker processes which serve on the inherited socket, and
+    restart the ones which exit unexpectedly.
+
+    Each worker is connected to the hub by the other inherited socket,
+    the hub relays events and calls between workers.
+    """
+
+    def __init__(self, command, env, fd, processes):
+        self.command = command
+        self.env = env
+        self.fd = fd
+        self.processes = processes
+        self.workers = {}
+        self.hub = Hub()
+        self._conns = {}
+        self._failures = {}
+        self._next_start = {}
+
+    def _start(self, i):
+        sock, child = self.hub.connect()
+        command = self.command + [
+            '--worker-fd', str(self.fd), '--hub-fd', str(child.fileno()),
+            '--worker-index', str(i)]
+        try:
+            p = Popen(command, env=self.env,
+                      pass_fds=[self.fd, child.fileno()])
+        except Exception:
+            self.hub.close(sock)
+            raise
+        finally:
+            child.close()
+        logging.info('Start worker %d (pid %d)', i, p.pid)
+        self.workers[i] = p, time.time()
+        self._conns[i] = sock
+
+    def _check(self, i, now):
+        """Restart worker i if it exits, delay the restart if it keeps
+        crashing."""
+        if i in self.workers:
+            p, started = self.workers[i]
+            rc = p.poll()
+            if rc is None:
+                return
+            del self.workers[i]
+            self.hub.close(self._conns.pop(i))
+            failures = self._failures.get(i, 0) + 1 \
+                if now - started < MIN_UPTIME else 0
+            self._failures[i] = failures
+            delay = min(RESTART_DELAY * 2 ** failures, MAX_RESTART_DELAY) \
+                if failures else 0
+            logging.warning('Worker %d (pid %d) exited with %s, restart it '
+                            'after %d seconds', i, p.pid, rc, delay)
+            self._next_start[i] = now + delay
+        if now >= self._next_start.get(i, 0):
+            self._start(i)
+
+    def run(self, interval=0.5):
+        """Start all the workers, watch them until SIGINT or SIGTERM."""
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        try:
+            for i in range(self.processes):
+                self._start(i)
+            while True:
+                self.hub.poll(interval)
+                now = time.time()
+                for i in range(self.processes):
+                    self._check(i, now)
+        except (KeyboardInterrupt, SystemExit):
+            logging.info('Stop %d workers', len(self.workers))
+        finally:
+            self.stop()
+
+    def stop(self):
+        for p, started in self.workers.values():
+            if p.poll() is None:
+                p.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        for p, started in self.workers.values():
+            try:
+                p.wait(max(0, deadline - time.time()))
+            except TimeoutExpired:
+                p.kill()
+                p.wait()
+        self.workers.clear()
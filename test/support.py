@@ -0,0 +1,22 @@
+import importlib
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_webui(name):
+    """Import module of pyarmor-webui in this source tree.
+
+    The modules use relative imports, so the source path is imported as
+    package "webui" first.
+    """
+    if 'webui' not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            'webui', os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['webui'] = module
+        spec.loader.exec_module(module)
+    return importlib.import_module('webui.' + name)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from support import import_webui
+
+agent = import_webui('agent')
+handler = import_webui('handler')
+remote = import_webui('remote')
+scheduler = import_webui('scheduler')
+server = import_webui('server')
+
+TOKEN = 'secret'
+
+
+class FakeProject(object):
+    """Copy main.py to output instead of running pyarmor, nothing is
+    copied if on_build returns False."""
+
+    def __init__(self, name, on_build=None):
+        self.name = name
+        self.on_build = on_build
+
+    def _build_target(self, path, project):
+        if self.on_build and self.on_build() is False:
+            return
+        os.makedirs(project['output'])
+        with open(os.path.join(project['src'], 'main.py')) as f:
+            data = f.read()
+        with open(os.path.join(project['output'], 'main.py'), 'w') as f:
+            f.write('# %s\n%s' % (self.name, data))
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+        self.src = os.path.join(self.path, 'src')
+        os.makedirs(self.src)
+        with open(os.path.join(self.src, 'main.py'), 'w') as f:
+            f.write('print("hello")\n')
+        with open(os.path.join(self.src, '.env'), 'w') as f:
+            f.write('A=1\n')
+        scheduler.configure(8, 1)
+        self.servers = []
+
+    def tearDown(self):
+        for httpd in self.servers:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def start_agent(self, name, on_build=None):
+        config = dict(server.__config__,
+                      homepath=os.path.join(self.path, name))
+        root = handler.BaseHandler(config)
+        root.children.append(agent.AgentHandler(
+            config, FakeProject(name, on_build)))
+        cls = type('RequestHandler', (agent.AgentRequestHandler,),
+                   dict(root_handler=root, token=TOKEN))
+        httpd = server.HelperServer(('127.0.0.1', 0), cls)
+        self.servers.append(httpd)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return httpd, 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+    def make_pool(self, urls, token=TOKEN):
+        return remote.AgentPool(urls, os.path.join(self.path, 'remote'),
+                                token)
+
+    def build(self, pool, name):
+        output = os.path.join(self.path, name)
+        url = pool.build(self.src, output, {})
+        with open(os.path.join(output, 'main.py')) as f:
+            return url, f.readline().strip()
+
+    def test_dispatch(self):
+        event = threading.Event()
+        urls = [self.start_agent('a%d' % i, event.wait)[1] for i in range(3)]
+        pool = self.make_pool(urls)
+        results = []
+
+        def build(name):
+            results.append(self.build(pool, name))
+
+        threads = [threading.Thread(target=build, args=('out%d' % i,))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        event.set()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(sorted([x[0] for x in results]), sorted(urls))
+        for url, line in results:
+            self.assertEqual(line, '# a%d' % urls.index(url))
+
+        bundles = os.path.join(self.path, 'a0', 'agents', 'bundles')
+        digest = os.listdir(bundles)[0]
+        self.assertTrue(os.path.exists(os.path.join(bundles, digest,
+                                                    '.env')))
+
+    def test_requeue(self):
+        def lost():
+            # Stop the agent in the middle of build
+            threading.Thread(target=lambda: (httpd.shutdown(),
+                                             httpd.server_close())).start()
+            time.sleep(1)
+            return False
+
+        httpd, lost_url = self.start_agent('lost', lost)
+        url = self.start_agent('good')[1]
+        pool = self.make_pool([lost_url, url])
+        self.assertEqual(self.build(pool, 'out'), (url, '# good'))
+        self.assertFalse(pool.agents[0].alive)
+        self.servers.remove(httpd)
+
+    def test_cancel(self):
+        started = threading.Event()
+
+        def wait_cancel():
+            started.set()
+            job = scheduler.current_job()
+            while not job.cancelled:
+                time.sleep(0.1)
+            raise RuntimeError('killed')
+
+        url = self.start_agent('a', wait_cancel)[1]
+        pool = self.make_pool([url])
+        errors = []
+
+        def build():
+            try:
+                scheduler.get_scheduler().run(
+                    'p1', lambda: self.build(pool, 'out'))
+            except scheduler.JobCancelled as e:
+                errors.append(e)
+
+        t = threading.Thread(target=build)
+        t.start()
+        self.assertTrue(started.wait(10))
+        scheduler.get_scheduler().cancel(key='p1')
+        t.join(10)
+        self.assertEqual(len(errors), 1)
+        for _ in range(20):
+            if not scheduler.get_scheduler().jobs():
+                break
+            time.sleep(0.1)
+        self.assertEqual(scheduler.get_scheduler().jobs(), [])
+
+    def test_token(self):
+        url = self.start_agent('a')[1]
+        pool = self.make_pool([url], token='wrong')
+        with self.assertLogs(level='WARNING'):
+            with self.assertRaises(remote.RemoteError):
+                pool.agents[0].call('status')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from support import import_webui
+
+scheduler = import_webui('scheduler')
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def test_invalid_args(self):
+        s = scheduler.Scheduler()
+        for priority, timeout in (('x', None), (0, 'abc'), (0, -1)):
+            with self.assertRaises(RuntimeError):
+                s.run('1', lambda: 1, priority=priority, timeout=timeout)
+        self.assertEqual(s.run('1', lambda: 1, priority='5', timeout='1.5'),
+                         1)
+
+    def test_cancelled_after_return(self):
+        def func():
+            scheduler.current_job().cancel()
+            return 'done'
+
+        jobs = []
+        s = scheduler.Scheduler()
+        with self.assertRaises(scheduler.JobCancelled):
+            s.run('1', func, on_done=jobs.append)
+        self.assertEqual(jobs[0].state, 'cancelled')
+        self.assertEqual(s.jobs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import gzip
+import http.client
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from support import import_webui
+
+server = import_webui('server')
+bundle = import_webui('bundle')
+
+
+class StubHandler(object):
+
+    def dispatch(self, path, args):
+        return dict(path=path, args=args)
+
+    def get_etag(self, path, args):
+        return None
+
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, 'localhost')
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.wwwroot = server.__config__['wwwroot']
+        server.__config__['wwwroot'] = os.path.join(self.path, 'www')
+        os.makedirs(os.path.join(self.path, 'www', 'css'))
+        self.patch_handler(root_handler=StubHandler())
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        server.__config__['wwwroot'] = self.wwwroot
+        shutil.rmtree(self.path)
+
+    def patch_handler(self, **kwargs):
+        for k, v in kwargs.items():
+            old = getattr(server.HelperHandler, k)
+            self.addCleanup(setattr, server.HelperHandler, k, old)
+            setattr(server.HelperHandler, k, v)
+
+    def wait_log(self, cm, text):
+        """The access log is written after the response is sent."""
+        for _ in range(50):
+            if any(text in x for x in cm.output):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def start(self, httpd):
+        self.server = httpd
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def start_tcp(self):
+        self.start(server.HelperServer(('127.0.0.1', 0), server.HelperHandler))
+        conn = http.client.HTTPConnection(*self.server.server_address)
+        self.addCleanup(conn.close)
+        return conn
+
+    @unittest.skipIf(sys.platform == 'win32', 'no unix socket')
+    def test_unix_socket(self):
+        filename = os.path.join(self.path, 'webui.sock')
+        with open(filename, 'w'):
+            pass
+        with self.assertRaises(RuntimeError):
+            server.remove_stale_socket(filename)
+        os.remove(filename)
+
+        self.start(server.HelperUnixServer(filename, server.HelperHandler))
+        with self.assertRaises(RuntimeError):
+            server.remove_stale_socket(filename)
+
+        conn = UnixConnection(filename)
+        self.addCleanup(conn.close)
+        with self.assertLogs(level='INFO') as cm:
+            conn.request('POST', '/project/list', body=json.dumps({'a': 1}),
+                         headers={'Content-Type': 'application/json'})
+            res = conn.getresponse()
+            result = json.loads(res.read().decode())
+            self.assertTrue(self.wait_log(cm, 'unix POST /project/list 200'))
+        self.assertEqual(res.status, 200)
+        self.assertEqual(result['data'],
+                         dict(path='project/list', args={'a': 1}))
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.assertFalse(os.path.exists(filename))
+
+    @unittest.skipIf(sys.platform == 'win32', 'no unix socket')
+    def test_remove_stale_socket(self):
+        filename = os.path.join(self.path, 'webui.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(filename)
+        sock.close()
+        server.remove_stale_socket(filename)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_trust_proxy(self):
+        self.patch_handler(trust_proxy=True)
+        conn = self.start_tcp()
+        headers = {
+            'X-Forwarded-For': '10.0.0.1, 192.168.1.9',
+            'X-Forwarded-Host': 'example.com',
+            'X-Forwarded-Proto': 'https',
+            'X-Forwarded-Prefix': '/webui/',
+        }
+        with self.assertLogs(level='INFO') as cm:
+            conn.request('GET', '/css', headers=headers)
+            res = conn.getresponse()
+            res.read()
+            self.assertTrue(self.wait_log(cm, '192.168.1.9 GET /css 301'))
+        self.assertEqual(res.status, 301)
+        self.assertEqual(res.getheader('Location'),
+                         'https://example.com/webui/css/')
+
+    def test_untrusted_proxy(self):
+        conn = self.start_tcp()
+        headers = {
+            'X-Forwarded-For': '10.0.0.1',
+            'X-Forwarded-Host': 'example.com',
+        }
+        with self.assertLogs(level='INFO') as cm:
+            conn.request('GET', '/css', headers=headers)
+            res = conn.getresponse()
+            res.read()
+            self.assertTrue(self.wait_log(cm, '127.0.0.1 GET /css 301'))
+        self.assertEqual(res.status, 301)
+        self.assertEqual(res.getheader('Location'), '/css/')
+
+    def post(self, conn, body, headers=None):
+        conn.request('POST', '/project/list', body=body, headers=headers or {})
+        res = conn.getresponse()
+        return res, res.read()
+
+    def test_post_body(self):
+        conn = self.start_tcp()
+        gz = {'Content-Encoding': 'gzip'}
+        res, data = self.post(conn, gzip.compress(b'{"a": 1}'), gz)
+        self.assertEqual(json.loads(data.decode())['data']['args'], {'a': 1})
+
+        for body, headers, status in (
+                (b'not gzip', gz, 400),
+                (gzip.compress(b'{"a": 1}')[:-12], gz, 400),
+                (gzip.compress(b' ' * (server.MAX_BODY_SIZE + 1)), gz, 413),
+                (b'{"a": ', None, 400),
+                (b'{}', {'Content-Encoding': 'br'}, 415)):
+            conn = http.client.HTTPConnection(*self.server.server_address)
+            self.addCleanup(conn.close)
+            with self.assertLogs(level='WARNING'):
+                res, data = self.post(conn, body, headers)
+            self.assertEqual(res.status, status, body[:10])
+
+    def test_chunked_json(self):
+        conn = self.start_tcp()
+        res, data = self.post(conn, json.dumps({'a': 'x' * 4096}),
+                              {'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.version, 11)
+        self.assertEqual(res.getheader('Transfer-Encoding'), 'chunked')
+        result = json.loads(gzip.decompress(data).decode())
+        self.assertEqual(len(result['data']['args']['a']), 4096)
+
+    def test_static_bundle(self):
+        www = server.__config__['wwwroot']
+        with open(os.path.join(www, 'index.html'), 'w') as f:
+            f.write('<html></html>')
+        with open(os.path.join(www, 'css', 'app.css'), 'w') as f:
+            f.write('body {}')
+        filename = os.path.join(self.path, 'home', bundle.BUNDLE_FILE)
+        b = bundle.open_bundle(www, filename,
+                               server.HelperHandler.extensions_map)
+        self.addCleanup(b.close)
+        self.patch_handler(bundle=b)
+
+        os.remove(os.path.join(www, 'index.html'))
+        conn = self.start_tcp()
+        conn.request('GET', '/')
+        res = conn.getresponse()
+        self.assertEqual(res.read(), b'<html></html>')
+        self.assertEqual(res.getheader('Content-type'), 'text/html')
+
+        conn.request('GET', '/css/app.css?v=1')
+        res = conn.getresponse()
+        self.assertEqual(res.read(), b'body {}')
+        self.assertEqual(res.getheader('Content-type'), 'text/css')
+        etag = res.getheader('ETag')
+
+        conn.request('GET', '/css/app.css', headers={'If-None-Match': etag})
+        res = conn.getresponse()
+        res.read()
+        self.assertEqual(res.status, 304)
+
+        for path, status in (('/css', 301), ('/css/', 404),
+                             ('/../css/app.css', 200), ('/none', 404)):
+            conn.request('HEAD', path)
+            res = conn.getresponse()
+            res.read()
+            self.assertEqual(res.status, status, path)
+
+        # Rebuild the stale bundle
+        signature = bundle.read_signature(filename)
+        b2 = bundle.open_bundle(www, filename,
+                                server.HelperHandler.extensions_map)
+        self.addCleanup(b2.close)
+        self.assertNotEqual(bundle.read_signature(filename), signature)
+        self.assertIsNone(b2.lookup('index.html'))
+
+
+if __name__ == '__main__':
+    unittest.main()
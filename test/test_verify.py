@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from support import import_webui
+
+scheduler = import_webui('scheduler')
+verify = import_webui('verify')
+
+
+class VerifyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_onedir_bundle(self):
+        bundle = os.path.join(self.path, 'dist', 'main')
+        os.makedirs(bundle)
+        exe = 'main.exe' if sys.platform == 'win32' else 'main'
+        checks = verify.make_checks(self.path, ['main.py'], bundle)
+        self.assertEqual(checks[0]['path'], os.path.join(bundle, exe))
+        self.assertEqual(checks[0]['command'], [os.path.join(bundle, exe)])
+
+    def test_run_error(self):
+        filename = os.path.join(self.path, 'main')
+        with open(filename, 'w') as f:
+            f.write('not executable')
+        check = dict(entry='main.py', path=filename, command=[filename],
+                     expected=None)
+        result = verify.run_check(check, 5)
+        self.assertFalse(result['passed'])
+        self.assertIn('Failed to run', result['error'])
+
+    def test_no_checks(self):
+        with self.assertRaises(RuntimeError):
+            verify.run_checks([])
+
+    def test_cancelled(self):
+        filename = os.path.join(self.path, 'main.py')
+        with open(filename, 'w') as f:
+            f.write('print("ok")')
+        check = verify.make_checks(self.path, ['main.py'])[0]
+        self.assertTrue(verify.run_check(check, 30)['passed'])
+
+        job = scheduler.Job('1')
+        job.cancel()
+        with self.assertRaises(scheduler.JobCancelled):
+            verify.run_check(check, 30, job)
+
+
+if __name__ == '__main__':
+    unittest.main()
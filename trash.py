@@ -0,0 +1,93 @@
+import itertools
+import logging
+import os
+import shutil
+import threading
+
+from queue import Queue
+
+TRASH_PATH = 'trash'
+
+_trash = None
+_queue = Queue()
+_thread = None
+_lock = threading.Lock()
+_counter = itertools.count(1)
+
+
+def _reap():
+    while True:
+        path = _queue.get()
+        logging.debug('Delete "%s"', path)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logging.warning('Delete "%s" failed: %s', path, e)
+        _queue.task_done()
+
+
+def _schedule(path):
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_reap, name='trash-reaper')
+            _thread.daemon = True
+            _thread.start()
+    _queue.put(path)
+
+
+def configure(path, clean=True):
+    """Set trash path, and delete the leftovers of last run if clean."""
+    global _trash
+    _trash = path
+    if clean and os.path.exists(path):
+        for x in os.scandir(path):
+            _schedule(x.path)
+
+
+def remove(path):
+    """Move path to trash and delete it in background thread.
+
+    The path is renamed in trash path or in its parent path if trash
+    is on the other device, so it returns at once.
+    """
+    if not os.path.lexists(path):
+        return
+    path = os.path.normpath(path)
+    name = '%s-%d-%d' % (os.path.basename(path), os.getpid(), next(_counter))
+    target = None
+    if _trash:
+        try:
+            if not os.path.exists(_trash):
+                os.makedirs(_trash)
+            target = os.path.join(_trash, name)
+            os.rename(path, target)
+        except OSError:
+            target = None
+    if target is None:
+        target = os.path.join(os.path.dirname(path), '.%s.trash' % name)
+        os.rename(path, target)
+    logging.info('Move "%s" to trash', path)
+    _schedule(target)
+
+
+def wait():
+    """Wait until all the paths in trash are deleted."""
+    _queue.join()
+
+
+def make_staging(path):
+    """Return a new path beside path to build the new output."""
+    path = os.path.normpath(path)
+    staging = '%s.staging-%d-%d' % (path, os.getpid(), next(_counter))
+    remove(staging)
+    return staging
+
+
+def swap(staging, path):
+    """Replace path with staging, the old path is moved to trash."""
+    remove(path)
+    os.rename(staging, path)
@@ -0,0 +1,141 @@
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .manifest import hash_file
+except Exception:
+    from manifest import hash_file
+
+CACHE_FILE = 'validate-cache.json'
+
+# Drop the cache if it has more entries
+MAX_ENTRIES = 100000
+
+# Compile in worker processes only if there are so many files
+MIN_PARALLEL = 8
+
+INTERPRETER = '%s-%d.%d' % ((sys.implementation.name,)
+                            + sys.version_info[:2])
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def compile_file(filename):
+    """Return None if the script could be compiled, else the error.
+
+    >>> compile_file(__file__)
+    """
+    try:
+        with open(filename, 'rb') as f:
+            compile(f.read(), filename, 'exec', dont_inherit=True)
+    except SyntaxError as e:
+        return {'line': e.lineno, 'offset': e.offset,
+                'message': '%s: %s' % (e.__class__.__name__, e.msg)}
+    except (ValueError, UnicodeDecodeError) as e:
+        return {'line': None, 'offset': None,
+                'message': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def _compile_files(filenames):
+    return [compile_file(x) for x in filenames]
+
+
+def get_executor():
+    """Return the pool of worker processes, it's started at first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def format_errors(errors):
+    """Return the errors as lines "file:line:offset: message"."""
+    return '\n'.join(['%s:%s:%s: %s' % (x['file'], x['line'] or 0,
+                                        x['offset'] or 0, x['message'])
+                      for x in errors])
+
+
+class SourceValidator(object):
+    """Compile scripts in parallel, cache the result by content hash.
+
+    The cache key is hash of the script and interpreter version, it's
+    saved in the data file. The hash is reused if the size and mtime of
+    the file are same as last time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._results = None
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._results is None:
+            try:
+                with open(self.filename) as f:
+                    self._results = json.load(f)
+            except (OSError, ValueError):
+                self._results = {}
+        return self._results
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(self._results, f)
+        os.replace(tmpname, self.filename)
+
+    def _key(self, filename):
+        st = os.stat(filename)
+        item = self._hashes.get(filename)
+        if not item or item[:2] != (st.st_size, st.st_mtime_ns):
+            item = st.st_size, st.st_mtime_ns, hash_file(filename)
+            self._hashes[filename] = item
+        return '%s:%s' % (INTERPRETER, item[2])
+
+    def validate(self, src, files):
+        """Return the list of errors of relative paths in src.
+
+        Each error has fields "file", "line", "offset" and "message".
+        """
+        with self._lock:
+            results = self._load()
+            keys = [(x, self._key(os.path.join(src, x))) for x in files]
+            found = dict([(k, results[k]) for x, k in keys if k in results])
+        todo = [(x, k) for x, k in keys if k not in found]
+
+        if todo:
+            filenames = [os.path.join(src, x) for x, k in todo]
+            if len(todo) < MIN_PARALLEL:
+                errors = _compile_files(filenames)
+            else:
+                n = max(1, len(filenames) // (os.cpu_count() or 1) // 4)
+                chunks = [filenames[i:i+n]
+                          for i in range(0, len(filenames), n)]
+                errors = []
+                for x in get_executor().map(_compile_files, chunks):
+                    errors.extend(x)
+            logging.info('Compile %d scripts, %d are cached',
+                         len(todo), len(keys) - len(todo))
+            found.update(zip([k for x, k in todo], errors))
+            with self._lock:
+                if len(results) + len(todo) > MAX_ENTRIES:
+                    results.clear()
+                results.update(zip([k for x, k in todo], errors))
+                self._save()
+
+        return [dict(found[k], file=x) for x, k in keys if found[k]]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
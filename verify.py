@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, Popen, TimeoutExpired
+from tempfile import TemporaryDirectory
+
+try:
+    from .scheduler import JobCancelled, current_job, kill_tree
+except Exception:
+    from scheduler import JobCancelled, current_job, kill_tree
+
+DEFAULT_TIMEOUT = 30
+
+# Keep the last N chars of stdout and stderr in the result
+MAX_OUTPUT = 2000
+
+
+def find_script(output, entry):
+    """Return the obfuscated entry script in output, None if not found.
+
+    The exact mode puts the scripts in output directly, the others keep
+    the relative path in src.
+    """
+    entry = entry.replace('\\', '/')
+    for x in (entry, os.path.basename(entry)):
+        filename = os.path.join(output, *x.split('/'))
+        if os.path.isfile(filename):
+            return filename
+
+
+def find_bundle(bundle):
+    """Return the executable of bundle, it's in the folder of the same
+    name for one folder bundle."""
+    if os.path.isdir(bundle):
+        name = os.path.basename(bundle.rstrip('/\\'))
+        if sys.platform == 'win32' and not name.endswith('.exe'):
+            name += '.exe'
+        return os.path.join(bundle, name)
+    return bundle
+
+
+def make_checks(output, entries, bundle=None, options=None):
+    """Return the list of checks of all the entries or the bundle.
+
+    The options could set "args" and "expected" of each entry, the
+    expected is a regular expression searched in stdout.
+    """
+    options = options if isinstance(options, dict) else {}
+    args = options.get('args') or {}
+    expected = options.get('expected') or {}
+    if bundle:
+        items = [(entries[0] if entries else bundle, find_bundle(bundle),
+                  [])]
+    else:
+        items = [(x, find_script(output, x), [sys.executable])
+                 for x in entries]
+    return [{
+        'entry': name,
+        'path': path,
+        'command': prefix + [path] + list(args.get(name, [])),
+        'expected': expected.get(name),
+    } for name, path, prefix in items]
+
+
+def _check_cancelled(job):
+    if job is not None and job.cancelled:
+        raise JobCancelled('Job %s is %s' % (job.id, job.reason))
+
+
+def run_check(check, timeout, job=None):
+    """Run the command in a temporary path, return the result.
+
+    Raise JobCancelled if the job is cancelled before or while the
+    command runs.
+    """
+    _check_cancelled(job)
+    result = dict(entry=check['entry'], passed=False, returncode=None,
+                  duration=0, stdout='', stderr='', error=None)
+    if not (check['path'] and os.path.exists(check['path'])):
+        result['error'] = 'No %s found in output' % check['entry']
+        return result
+
+    kwargs = {} if sys.platform == 'win32' else {'start_new_session': True}
+    t = time.time()
+    with TemporaryDirectory() as cwd:
+        try:
+            p = Popen(check['command'], cwd=cwd, stdin=PIPE, stdout=PIPE,
+                      stderr=PIPE, **kwargs)
+        except OSError as e:
+            result['error'] = 'Failed to run %s: %s' % (check['path'], e)
+            return result
+        if job:
+            job.add_pid(p.pid)
+        try:
+            stdout, stderr = p.communicate(timeout=timeout)
+        except TimeoutExpired:
+            kill_tree(p.pid)
+            stdout, stderr = p.communicate()
+            result['error'] = 'Timeout after %s seconds' % timeout
+        finally:
+            if job:
+                job.remove_pid(p.pid)
+    _check_cancelled(job)
+
+    result['duration'] = round(time.time() - t, 6)
+    result['returncode'] = p.returncode
+    result['stdout'] = stdout.decode(errors='replace')[-MAX_OUTPUT:]
+    result['stderr'] = stderr.decode(errors='replace')[-MAX_OUTPUT:]
+    if result['error'] is None:
+        if p.returncode != 0:
+            result['error'] = 'Exit code %s' % p.returncode
+        elif check['expected'] and \
+                not re.search(check['expected'], result['stdout']):
+            result['error'] = 'Output does not match "%s"' \
+                % check['expected']
+        else:
+            result['passed'] = True
+    return result
+
+
+def run_checks(checks, timeout=None, jobs=None):
+    """Run all the checks at the same time, at most `jobs` processes.
+
+    Return {"passed": bool, "duration": seconds, "results": [...]}.
+    """
+    if not checks:
+        raise RuntimeError('No script to verify')
+    timeout = timeout or DEFAULT_TIMEOUT
+    job = current_job()
+    t = time.time()
+    n = max(1, min(len(checks), jobs or os.cpu_count() or 1))
+    with ThreadPoolExecutor(n) as executor:
+        results = list(executor.map(
+            lambda x: run_check(x, timeout, job), checks))
+    return {
+        'passed': all([x['passed'] for x in results]),
+        'duration': round(time.time() - t, 6),
+        'results': results,
+    }
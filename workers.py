@@ -0,0 +1,224 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+from subprocess import Popen
+
+try:
+    from .scheduler import current_job
+except Exception:
+    from scheduler import current_job
+
+# Module name: (entry function in worker, arguments of cold spawn)
+ENTRIES = {
+    'pyarmor.pyarmor': ('main', ['-m', 'pyarmor.pyarmor']),
+    'pyarmor.cli.__main__': ('main_entry', ['-m', 'pyarmor.cli']),
+    'PyInstaller.__main__': ('run', ['-m', 'PyInstaller']),
+}
+
+_pool = None
+
+
+def _maxrss():
+    """Return max resident set size of current process in KB."""
+    try:
+        from resource import getrusage, RUSAGE_SELF
+    except ImportError:
+        return 0
+    rss = getrusage(RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _worker_main(conn, modname):
+    """Run in worker process, import module once and serve jobs."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)-8s %(message)s',
+    )
+    if hasattr(os, 'setsid'):
+        # Make it a session leader, so the whole tree could be killed
+        os.setsid()
+    entry = getattr(importlib.import_module(modname), ENTRIES[modname][0])
+    homepath = os.getcwd()
+    # Pyarmor changes the handlers and level of root logger for each run
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+
+        args, cwd = job
+        rc = 0
+        try:
+            if cwd:
+                os.chdir(cwd)
+            entry(list(args))
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else 0 if e.code is None \
+                else 1
+        except Exception as e:
+            logging.error('%s', e)
+            rc = 1
+        finally:
+            os.chdir(homepath)
+            for h in root.handlers[:]:
+                if h not in handlers:
+                    root.removeHandler(h)
+                    h.close()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+        conn.send((rc, _maxrss()))
+
+
+class Worker(object):
+
+    def __init__(self, modname):
+        ctx = multiprocessing.get_context('spawn')
+        self.modname = modname
+        self.jobs = 0
+        self.maxrss = 0
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main,
+                                   args=(child_conn, modname),
+                                   name='pyarmor-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def run(self, args, cwd=None):
+        """Return exit code, raise EOFError if worker is dead."""
+        try:
+            self.conn.send((args, cwd))
+            rc, self.maxrss = self.conn.recv()
+        except (OSError, EOFError):
+            raise EOFError('worker %s is dead' % self.pid)
+        self.jobs += 1
+        return rc
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class WorkerPool(object):
+    """Long-lived worker processes which have imported the module.
+
+    Each module has at most `size` idle workers. A worker is recycled
+    after `max_jobs` jobs, or its max rss exceeds `max_memory` (MB).
+    """
+
+    def __init__(self, size=2, max_jobs=50, max_memory=0):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def prestart(self, modname):
+        with self._lock:
+            idle = self._idle.setdefault(modname, [])
+            while len(idle) < self.size:
+                idle.append(Worker(modname))
+
+    def _acquire(self, modname):
+        with self._lock:
+            idle = self._idle.setdefault(modname, [])
+            while idle:
+                worker = idle.pop()
+                if worker.process.is_alive():
+                    return worker
+                worker.close()
+        logging.info('Start worker for %s', modname)
+        return Worker(modname)
+
+    def _release(self, worker):
+        if worker.jobs >= self.max_jobs or (
+                self.max_memory and worker.maxrss > self.max_memory * 1024):
+            logging.info('Recycle worker %s after %d jobs (maxrss %d KB)',
+                         worker.pid, worker.jobs, worker.maxrss)
+            worker.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(worker.modname, [])
+            if len(idle) < self.size:
+                idle.append(worker)
+                return
+        worker.close()
+
+    def run(self, modname, args, cwd=None):
+        worker = self._acquire(modname)
+        job = current_job()
+        if job:
+            job.add_pid(worker.pid)
+        try:
+            rc = worker.run(args, cwd=cwd)
+        except EOFError as e:
+            worker.close()
+            if job and job.cancelled:
+                return -1
+            logging.warning('%s, fall back to new process', e)
+            return run_cold(modname, args, cwd=cwd)
+        finally:
+            if job:
+                job.remove_pid(worker.pid)
+        self._release(worker)
+        return rc
+
+    def close(self):
+        with self._lock:
+            workers = sum(self._idle.values(), [])
+            self._idle.clear()
+        for w in workers:
+            w.close()
+
+
+def configure(size=0, max_jobs=50, max_memory=0, prestart=None):
+    """Enable worker pool if size is not 0."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = WorkerPool(size, max_jobs, max_memory) if size else None
+    if _pool and prestart:
+        _pool.prestart(prestart)
+
+
+def run_cold(modname, args, cwd=None, debug=False):
+    cmd = [sys.executable, '-d'] if debug else [sys.executable]
+    kwargs = {} if sys.platform == 'win32' else {'start_new_session': True}
+    p = Popen(cmd + ENTRIES[modname][1] + list(args), cwd=cwd, **kwargs)
+    job = current_job()
+    if job:
+        job.add_pid(p.pid)
+    try:
+        p.wait()
+    finally:
+        if job:
+            job.remove_pid(p.pid)
+    return p.returncode
+
+
+def run_module(modname, args, cwd=None, debug=False):
+    """Run module with args in worker, return exit code.
+
+    It's same as `python -m modname args`, but no interpreter starts
+    if there is any idle worker.
+    """
+    if _pool is None or debug:
+        return run_cold(modname, args, cwd=cwd, debug=debug)
+    return _pool.run(modname, args, cwd=cwd)